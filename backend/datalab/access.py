@@ -0,0 +1,220 @@
+""" Persisted inverted index of the permission values of a DataLab's records.
+
+    Students are given access to the records of a DataLab or form whose
+    permission field matches their email or LTI attributes. Rather than scanning
+    the permission column of the built table on every request, each lowercased
+    permission value is mapped to the positions of its records in the relations
+    table, along with the value of the groupBy field of the first such record.
+
+    The permission fields of the DataLab and its forms are always included in the
+    relations table, so the index can be built without building the DataLab.
+    It is rebuilt whenever the access of the DataLab or its forms is refreshed,
+    i.e. whenever its relations or sources change, and is otherwise rebuilt
+    lazily if it does not match the current relations table.
+
+    Each index is built once per relations table: the first process to insert
+    it builds its entries, while any other process waits for them. Indexes of
+    previous relations tables are kept for a grace period, as requests which are
+    already in flight may still read them. """
+
+from collections import namedtuple
+from datetime import datetime as dt, timedelta
+from hashlib import md5
+from mongoengine.errors import NotUniqueError
+import json
+import time
+import uuid
+
+from accounts.models import lti
+from ontask.settings import DATALAB_BUILD_TIMEOUT
+
+from .models import Datalab, DatalabAccessIndex, DatalabAccessEntry
+
+AccessRecords = namedtuple("AccessRecords", ["rows", "default_group", "grouped"])
+
+# Seconds between checks for the entries of an index built by another process
+BUILD_POLL_INTERVAL = 0.25
+
+# Seconds that an index built from a previous relations table is kept for
+INDEX_GRACE_PERIOD = 300
+
+
+def relations_version(relations):
+    """ Hash of a relations table, which is stored on the DataLab whenever its
+        relations table is written (see Datalab.get_relations_version) """
+    return md5(
+        json.dumps(relations, default=str, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def permission_values(item, user):
+    """ The lowercased values which identify a user against the permission field
+        of a DataLab or form, based on the types of access that it allows """
+    values = []
+    if item.emailAccess:
+        values.append(user.email.lower())
+    if item.ltiAccess:
+        try:
+            lti_object = lti.objects.get(user=user.id)
+            values.extend([value.lower() for value in lti_object.payload.values()])
+        except:
+            pass
+
+    return values
+
+
+def _claim_index(datalab_id, permission, group_by, version, grouped):
+    """ Returns the index of the given key, and a token identifying this process
+        as its builder, or None if another process has claimed it """
+    owner = uuid.uuid4().hex
+    expires = dt.utcnow() + timedelta(seconds=DATALAB_BUILD_TIMEOUT)
+    key = dict(
+        datalab=datalab_id, permission=permission, group_by=group_by, version=version
+    )
+
+    try:
+        index = DatalabAccessIndex(
+            grouped=grouped, owner=owner, expires=expires, **key
+        ).save(force_insert=True)
+        return index, owner
+    except NotUniqueError:
+        pass
+
+    # Take over the index if its builder has not completed it in time
+    taken = DatalabAccessIndex.objects(
+        complete=False, expires__lt=dt.utcnow(), **key
+    ).update_one(set__owner=owner, set__expires=expires)
+
+    return DatalabAccessIndex.objects(**key).first(), owner if taken else None
+
+
+def _build_index(datalab, permission, group_by, version):
+    """ Builds the index of the given permission field, unless it has already
+        been built from the same relations table, in which case that index is
+        used. Returns the index, and its entries if they were built here """
+    grouped = bool(group_by) and any(group_by in record for record in datalab.relations)
+
+    index, owner = _claim_index(datalab.id, permission, group_by, version, grouped)
+    while owner is None:
+        if index is not None and index.complete:
+            return index, None
+
+        time.sleep(BUILD_POLL_INTERVAL)
+        index, owner = _claim_index(datalab.id, permission, group_by, version, grouped)
+
+    entries = {}
+    groups = {}
+    for position, record in enumerate(datalab.relations):
+        value = record.get(permission)
+        if not isinstance(value, str) or value == "":
+            continue
+
+        value = value.lower()
+        if value not in entries:
+            entries[value] = []
+            groups[value] = record.get(group_by) if grouped else None
+        entries[value].append(position)
+
+    # Discard any entries written by a builder whose claim was taken over
+    DatalabAccessEntry.objects(index=index.id).delete()
+
+    if entries:
+        DatalabAccessEntry.objects.insert(
+            [
+                DatalabAccessEntry(
+                    index=index, value=value, rows=rows, group=groups[value]
+                )
+                for value, rows in entries.items()
+            ],
+            load_bulk=False,
+        )
+
+    # Readers only use an index once all of its entries have been written
+    DatalabAccessIndex.objects(id=index.id, owner=owner).update_one(
+        set__complete=True, set__built_at=dt.utcnow()
+    )
+    index.complete = True
+
+    return index, entries
+
+
+def collect_access_indexes(datalab):
+    """ Deletes the indexes of a DataLab that were built from a previous relations
+        table. Requests which loaded the DataLab before its relations table
+        changed may still be reading them, so they are only deleted once they
+        have been superseded for longer than INDEX_GRACE_PERIOD """
+    now = dt.utcnow()
+    version = (
+        Datalab.objects(id=datalab.id).scalar("relationsVersion").first()
+        or datalab.get_relations_version()
+    )
+
+    # The relations table may have changed back to the version of an index
+    DatalabAccessIndex.objects(
+        datalab=datalab.id, version=version, superseded_at__ne=None
+    ).update(set__superseded_at=None)
+    DatalabAccessIndex.objects(
+        datalab=datalab.id, version__ne=version, superseded_at=None
+    ).update(set__superseded_at=now)
+
+    expired = DatalabAccessIndex.objects(
+        datalab=datalab.id,
+        superseded_at__lt=now - timedelta(seconds=INDEX_GRACE_PERIOD),
+    ).scalar("id")
+    for index_id in list(expired):
+        DatalabAccessEntry.objects(index=index_id).delete()
+        DatalabAccessIndex.objects(id=index_id).delete()
+
+
+def build_access_index(datalab, permission, group_by=None):
+    """ Builds and stores the index of the given permission field of a DataLab,
+        unless it already exists for its current relations table, and collects
+        the indexes of previous relations tables. Returns a dict mapping each
+        permission value to its positions in the relations table """
+    if not permission:
+        return {}
+
+    index, entries = _build_index(
+        datalab, permission, group_by, datalab.get_relations_version()
+    )
+    collect_access_indexes(datalab)
+
+    if entries is None:
+        entries = {
+            entry.value: entry.rows
+            for entry in DatalabAccessEntry.objects(index=index.id)
+        }
+
+    return entries
+
+
+def find_records(datalab, permission, values, group_by=None):
+    """ Looks up the records of a DataLab whose permission field matches any of
+        the given lowercased values. Returns the positions of the records in the
+        relations table, in order, and the value of the group_by field of the
+        first of them. If group_by is not a column of the relations table, then
+        grouped is False and the default group must be found from the built
+        table instead """
+    if not permission or not values:
+        return AccessRecords([], None, False)
+
+    version = datalab.get_relations_version()
+    index = DatalabAccessIndex.objects(
+        datalab=datalab.id,
+        permission=permission,
+        group_by=group_by,
+        version=version,
+        complete=True,
+    ).first()
+
+    if index is None:
+        index, _ = _build_index(datalab, permission, group_by, version)
+
+    entries = list(DatalabAccessEntry.objects(index=index.id, value__in=values))
+    if not entries:
+        return AccessRecords([], None, index.grouped)
+
+    first = min(entries, key=lambda entry: entry.rows[0])
+    rows = sorted(set(row for entry in entries for row in entry.rows))
+
+    return AccessRecords(rows, first.group, index.grouped)
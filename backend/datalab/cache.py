@@ -0,0 +1,217 @@
+""" Materialized snapshots of built DataLab tables.
+
+    Snapshots are keyed by the DataLab's version vector (see Datalab.version), so
+    a snapshot is implicitly invalidated as soon as any datasource, form or module
+    it was built from changes. Two tiers are used: a small in-process LRU which
+    avoids deserializing the table on every access, and a DatalabSnapshot stored
+    in GridFS which is shared between the uwsgi and celery workers.
+
+    Builds are single-flight: concurrent requests for the same version of a
+    DataLab within a process wait for the thread that is already building it,
+    and processes wait on a DatalabBuildLock for the snapshot of the process
+    that holds it. A thundering herd therefore results in a single build. """
+
+from collections import OrderedDict
+from bson.objectid import ObjectId
+from datetime import datetime as dt, timedelta
+from mongoengine.errors import NotUniqueError
+import threading
+import pickle
+import time
+import uuid
+import zlib
+
+from ontask.settings import DATALAB_CACHE_SIZE, DATALAB_BUILD_TIMEOUT
+
+from .models import DatalabSnapshot, DatalabBuildLock
+
+import logging
+
+logger = logging.getLogger("ontask")
+
+# Seconds between checks for the snapshot of a build in another process
+BUILD_POLL_INTERVAL = 0.25
+
+_local_snapshots = OrderedDict()
+_local_lock = threading.Lock()
+
+# Builds in progress in this process, keyed by DataLab and version
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _read_local(datalab_id, version):
+    with _local_lock:
+        snapshot = _local_snapshots.get(datalab_id)
+        if snapshot is None or snapshot[0] != version:
+            return None
+
+        _local_snapshots.move_to_end(datalab_id)
+        return snapshot[1]
+
+
+def _write_local(datalab_id, version, frame):
+    with _local_lock:
+        _local_snapshots[datalab_id] = (version, frame)
+        _local_snapshots.move_to_end(datalab_id)
+
+        while len(_local_snapshots) > DATALAB_CACHE_SIZE:
+            _local_snapshots.popitem(last=False)
+
+
+def _read_persisted(datalab_id, version):
+    snapshot = DatalabSnapshot.objects(datalab=datalab_id, version=version).first()
+    if not snapshot or not snapshot.data:
+        return None
+
+    try:
+        return pickle.loads(zlib.decompress(snapshot.data.read()))
+    except Exception:
+        # A corrupt or unreadable snapshot is simply rebuilt
+        logger.exception("datalab.snapshot_read", extra={"datalab": datalab_id})
+        return None
+
+
+def _write_persisted(datalab, version, frame):
+    content = zlib.compress(pickle.dumps(frame, pickle.HIGHEST_PROTOCOL), 1)
+
+    # Only a single snapshot is kept per DataLab, so overwrite any stale one
+    snapshot = DatalabSnapshot.objects(datalab=datalab.id).first()
+    if not snapshot:
+        snapshot = DatalabSnapshot(datalab=datalab)
+
+    if snapshot.data:
+        snapshot.data.replace(content)
+    else:
+        snapshot.data.put(content)
+
+    snapshot.version = version
+    snapshot.save()
+
+
+def _acquire_build_lock(datalab_id, version):
+    """ Returns a token identifying this process as the owner of the build lock
+        of a DataLab, or None if another process holds it """
+    owner = uuid.uuid4().hex
+    expires = dt.utcnow() + timedelta(seconds=DATALAB_BUILD_TIMEOUT)
+
+    try:
+        DatalabBuildLock(
+            datalab=ObjectId(datalab_id), version=version, owner=owner, expires=expires
+        ).save(force_insert=True)
+        return owner
+    except NotUniqueError:
+        pass
+
+    # Take over the lock if its owner has not released it in time
+    taken = DatalabBuildLock.objects(
+        datalab=ObjectId(datalab_id), expires__lt=dt.utcnow()
+    ).update_one(set__version=version, set__owner=owner, set__expires=expires)
+
+    return owner if taken else None
+
+
+def _release_build_lock(datalab_id, owner):
+    DatalabBuildLock.objects(datalab=ObjectId(datalab_id), owner=owner).delete()
+
+
+def _build(datalab, datalab_id, version):
+    """ Builds and stores the snapshot of a DataLab, unless another process is
+        already doing so, in which case its snapshot is used once stored """
+    deadline = time.time() + DATALAB_BUILD_TIMEOUT
+
+    owner = _acquire_build_lock(datalab_id, version)
+    while owner is None and time.time() < deadline:
+        time.sleep(BUILD_POLL_INTERVAL)
+
+        frame = _read_persisted(datalab_id, version)
+        if frame is not None:
+            return frame
+
+        owner = _acquire_build_lock(datalab_id, version)
+
+    try:
+        if owner is not None:
+            # The previous owner may have stored the snapshot just before
+            # releasing the lock
+            frame = _read_persisted(datalab_id, version)
+            if frame is not None:
+                return frame
+        else:
+            logger.warning("datalab.build_lock_timeout", extra={"datalab": datalab_id})
+
+        frame = datalab.build()
+        _write_persisted(datalab, version, frame)
+
+        return frame
+    finally:
+        if owner is not None:
+            _release_build_lock(datalab_id, owner)
+
+
+def _load(datalab, datalab_id, version):
+    frame = _read_persisted(datalab_id, version)
+    if frame is None:
+        frame = _build(datalab, datalab_id, version)
+
+    _write_local(datalab_id, version, frame)
+
+    return frame
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.frame = None
+        self.error = None
+
+
+def load_snapshot(datalab):
+    """ Returns the built table of the given DataLab, building and storing a new
+        snapshot only if no snapshot exists for its current version """
+
+    datalab_id = str(datalab.id)
+    version = datalab.version
+
+    frame = _read_local(datalab_id, version)
+    if frame is not None:
+        return frame
+
+    key = (datalab_id, version)
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if flight.done.wait(DATALAB_BUILD_TIMEOUT):
+            if flight.error is not None:
+                raise flight.error
+            return flight.frame
+
+        # The build in this process is taking too long, so load it independently
+        return _load(datalab, datalab_id, version)
+
+    try:
+        flight.frame = _load(datalab, datalab_id, version)
+        return flight.frame
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def invalidate_snapshot(datalab_id):
+    """ Explicitly discard the snapshots of a DataLab, e.g. when it is deleted """
+
+    datalab_id = str(datalab_id)
+
+    with _local_lock:
+        _local_snapshots.pop(datalab_id, None)
+
+    for snapshot in DatalabSnapshot.objects(datalab=datalab_id):
+        snapshot.delete()
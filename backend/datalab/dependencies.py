@@ -0,0 +1,140 @@
+""" Dependency graph of datasources, DataLabs and forms.
+
+    A DataLab depends on the datasources and DataLabs used by its datasource
+    modules, as its relations table is built from them. Forms depend on the
+    DataLab they belong to, as the access to a form is derived from the relations
+    table of its DataLab. Form data is not part of any relations table, so forms
+    have no dependents of their own.
+
+    Actions are not part of the graph, as they store nothing derived from their
+    DataLab. They are evaluated from its snapshot, which is keyed by its version.
+
+    When a node changes, every node downstream of it is rebuilt exactly once,
+    in topological order. Nodes are grouped into layers, where each node only
+    depends on nodes of earlier layers, and the nodes of a layer are rebuilt in
+    parallel by the Celery workers. """
+
+from celery import chain, group
+from collections import defaultdict
+
+from form.models import Form
+
+from .models import Datalab
+
+import logging
+
+logger = logging.getLogger("ontask")
+
+
+def dependents(kind, node_id):
+    """ The nodes which directly depend on the given node """
+    node_id = str(node_id)
+
+    if kind in ["datasource", "datalab"]:
+        nodes = [
+            ("datalab", str(datalab.id))
+            for datalab in Datalab.objects(steps__datasource__id=node_id).only("id")
+        ]
+    else:
+        nodes = []
+
+    if kind == "datalab":
+        nodes.extend(
+            ("form", str(form.id)) for form in Form.objects(datalab=node_id).only("id")
+        )
+
+    return nodes
+
+
+def plan_rebuild(kind, node_id, skip=()):
+    """ Identifies every node downstream of the given node, to any depth, and
+        returns them as a list of layers in topological order. Nodes in skip,
+        which have already been rebuilt, are still used to order the others """
+    root = (kind, str(node_id))
+
+    edges = defaultdict(set)
+    in_degree = defaultdict(int)
+
+    visited = {root}
+    queue = [root]
+    while queue:
+        node = queue.pop()
+        for dependent in dependents(*node):
+            if dependent in edges[node]:
+                continue
+
+            edges[node].add(dependent)
+            in_degree[dependent] += 1
+
+            if dependent not in visited:
+                visited.add(dependent)
+                queue.append(dependent)
+
+    # Each layer holds the nodes whose dependencies are all in earlier layers
+    layers = []
+    remaining = dict(in_degree)
+    layer = [root]
+    while layer:
+        next_layer = []
+        for node in layer:
+            for dependent in edges[node]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    next_layer.append(dependent)
+
+        rebuilt = sorted(node for node in next_layer if node not in skip)
+        if rebuilt:
+            layers.append(rebuilt)
+        layer = next_layer
+
+    # DataLabs should never depend on each other in a cycle, but if they do then
+    # the nodes in the cycle are rebuilt last rather than not at all
+    cyclic = sorted(
+        node
+        for node, degree in remaining.items()
+        if degree > 0 and node not in skip
+    )
+    if cyclic:
+        logger.warning(
+            "datalab.dependency_cycle", extra={"root": root, "nodes": cyclic}
+        )
+        layers.append(cyclic)
+
+    return layers
+
+
+def rebuild_node(kind, node_id):
+    """ Rebuilds the state that a single node derives from its dependencies """
+    if kind == "datalab":
+        datalab = Datalab.objects(id=node_id).first()
+        if datalab:
+            datalab.refresh_relations(include_forms=False)
+
+    elif kind == "form":
+        form = Form.objects(id=node_id).first()
+        if form:
+            form.refresh_access()
+
+
+def propagate_change(kind, node_id, skip=()):
+    """ Rebuilds every node downstream of a node which has changed, with the
+        layers run in order and the nodes of each layer run in parallel """
+    from scheduler.tasks import rebuild_dependency
+
+    layers = plan_rebuild(kind, node_id, set(skip))
+
+    logger.info(
+        "datalab.propagate_change",
+        extra={
+            "kind": kind,
+            "id": str(node_id),
+            "layers": [[":".join(node) for node in layer] for layer in layers],
+        },
+    )
+
+    if not layers:
+        return
+
+    chain(
+        *[group(rebuild_dependency.si(*node) for node in layer) for layer in layers]
+    ).delay()
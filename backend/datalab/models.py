@@ -10,8 +10,14 @@ from mongoengine.fields import (
     EmbeddedDocumentField,
     DateTimeField,
     FloatField,
+    FileField,
+    DynamicField,
 )
+from hashlib import md5
+from datetime import datetime as dt
 import pandas as pd
+import json
+import uuid
 
 from container.models import Container
 from datasource.models import Datasource
@@ -85,17 +91,90 @@ class Datalab(Document):
     charts = EmbeddedDocumentListField(Chart)
 
     relations = ListField(DictField())
+    # Hash of the relations table, stored whenever the relations table is written
+    relationsVersion = StringField(null=True)
     permitted_users = ListField(StringField())
     ltiAccess = BooleanField(default=False)
     emailAccess = BooleanField(default=False)
     permission = StringField(null=True)
     restriction = StringField(choices=("private", "open"), default="private")
     groupBy = StringField(null=True)
+    # State of the rebuild of the relations table that follows a form change
+    relationsStatus = StringField(
+        choices=("pending", "complete", "failed"), default="complete"
+    )
+    # Identifies the latest requested rebuild, so that superseded rebuilds can be
+    # skipped
+    relationsRequest = StringField(null=True)
 
     @property
-    def data(self):
+    def version(self):
+        """ Version vector of everything the built table depends on. Any change to
+            a source's data, a form's data or design, or this DataLab's own modules
+            results in a different version, which invalidates its snapshot """
         from form.models import Form
-        from .utils import calculate_computed_field
+
+        source_ids = set()
+        form_ids = set()
+        for step in self.steps:
+            if step.type == "datasource":
+                source_ids.add(step.datasource.id)
+            elif step.type == "form":
+                form_ids.add(step.form)
+
+        vector = {}
+
+        for datasource in Datasource.objects(id__in=source_ids).only(
+            "lastUpdated", "dataRevision"
+        ):
+            vector[str(datasource.id)] = (
+                f"{datasource.lastUpdated}/{datasource.dataRevision}"
+            )
+
+        # Steps which are not datasources must be other DataLabs, whose versions
+        # already account for any forms used by their checkbox-group fields
+        for datalab in Datalab.objects(id__in=source_ids - set(vector)):
+            vector[str(datalab.id)] = datalab.version
+
+        for form in Form.objects(id__in=form_ids).only("revision"):
+            vector[str(form.id)] = form.revision
+
+        document = self.to_mongo()
+        vector["self"] = md5(
+            json.dumps(
+                [document.get(key) for key in ["steps", "order"]]
+                + [self.get_relations_version()],
+                default=str,
+                sort_keys=True,
+            ).encode("utf-8")
+        ).hexdigest()
+
+        return md5(json.dumps(vector, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @property
+    def frame(self):
+        """ The built table as a DataFrame, served from the snapshot cache if the
+            snapshot matches the current version. Must not be modified in place """
+        from .cache import load_snapshot
+
+        return load_snapshot(self)
+
+    def load_data(self, columns=None):
+        """ Loads the built table of this DataLab as a DataFrame, so that it can be
+            used as a module of another DataLab in the same way as a datasource """
+        data = self.frame
+        return data.copy() if columns is None else data.filter(items=columns)
+
+    @property
+    def data(self):
+        return self.frame.to_dict("records")
+
+    def build(self):
+        from .utils import compile_computed_field, load_module_data
+        from .resolver import get_resolver
+
+        resolver = get_resolver()
+        resolver.prefetch(self.steps)
 
         build_fields = []
         combined_data = pd.DataFrame(self.relations)
@@ -127,15 +206,7 @@ class Datalab(Document):
         for step_index, step in enumerate(self.steps):
             if step.type == "datasource":
                 step = step.datasource
-                try:
-                    datasource = Datasource.objects.get(id=step.id)
-                except:
-                    pass
-
-                try:
-                    datasource = Datalab.objects.get(id=step.id)
-                except:
-                    pass
+                datasource = resolver.module(step.id)
 
                 build_fields.append([step.labels[field] for field in step.fields])
 
@@ -155,19 +226,14 @@ class Datalab(Document):
                     ).stepIndex
                     form_module_id = datasource.steps[form_module_index].form
 
-                    form = Form.objects.get(id=form_module_id)
+                    form = resolver.form(form_module_id)
                     for form_field in form.fields:
                         if form_field.name == field:
                             included_fields.extend(form_field.columns)
 
-                data = (
-                    pd.DataFrame(data=datasource.data)
-                    .set_index(step.primary)
-                    .filter(items=included_fields)
-                    .rename(
-                        columns={field: step.labels[field] for field in step.fields}
-                    )
-                )
+                data = load_module_data(
+                    datasource, step.primary, included_fields
+                ).rename(columns={field: step.labels[field] for field in step.fields})
 
                 combined_data = combined_data.join(
                     data,
@@ -177,7 +243,7 @@ class Datalab(Document):
                 )
 
             elif step.type == "form":
-                form = Form.objects.get(id=step.form)
+                form = resolver.form(step.form)
                 data = pd.DataFrame(data=form.data)
 
                 build_fields.append([field.name for field in form.fields])
@@ -191,12 +257,10 @@ class Datalab(Document):
 
                 build_fields.append([field.name for field in step.fields])
 
+                # Each formula is compiled once and evaluated over all records
                 computed_fields = {
-                    field.name: combined_data.apply(
-                        lambda item: calculate_computed_field(
-                            field.formula, item, build_fields, {}
-                        ),
-                        axis=1,
+                    field.name: compile_computed_field(field.formula, build_fields)(
+                        combined_data
                     ).values
                     for field in step.fields
                 }
@@ -204,16 +268,143 @@ class Datalab(Document):
 
         combined_data.replace({pd.np.nan: None}, inplace=True)
 
-        return combined_data.to_dict("records")
+        return combined_data
+
+    def get_relations_version(self):
+        """ The stored hash of the relations table. DataLabs whose relations table
+            was written before the hash was stored have it computed once """
+        from .access import relations_version
+
+        if self.relationsVersion is None:
+            self.relationsVersion = relations_version(self.relations)
+            Datalab.objects(id=self.id).update_one(
+                set__relationsVersion=self.relationsVersion
+            )
+
+        return self.relationsVersion
+
+    def refresh_relations(self, include_forms=True):
+        """ Rebuilds the relations table, then the access of this DataLab and,
+            unless they are refreshed separately, of its forms """
+        from .utils import get_relations
+        from .access import relations_version
+        from form.models import Form
+
+        self.relations = get_relations(
+            self.steps,
+            datalab_id=self.id,
+            permission=self.permission,
+            group_by=self.groupBy,
+        )
+        self.relationsVersion = relations_version(self.relations)
+        Datalab.objects(id=self.id).update_one(
+            set__relations=self.relations, set__relationsVersion=self.relationsVersion
+        )
+
+        self.refresh_access()
+        if include_forms:
+            for form in Form.objects(datalab=self.id):
+                form.refresh_access()
+
+    def request_relations_refresh(self):
+        """ Schedules a rebuild of the relations table in the background. The
+            rebuild is delayed, and any request made in the meantime supersedes
+            this one, so that only the latest of a burst of changes rebuilds """
+        from scheduler.tasks import refresh_datalab_relations
+        from ontask.settings import RELATIONS_REFRESH_DELAY
+
+        request = uuid.uuid4().hex
+        Datalab.objects(id=self.id).update_one(
+            set__relationsRequest=request, set__relationsStatus="pending"
+        )
+        self.relationsRequest = request
+        self.relationsStatus = "pending"
+
+        refresh_datalab_relations.apply_async(
+            args=(str(self.id), request), countdown=RELATIONS_REFRESH_DELAY
+        )
 
     # Flat representation of which users should see this DataLab when they load the dashboard
     def refresh_access(self):
-        users = set(
-            record.get(self.permission, "").lower() for record in self.relations
-        )
-        for invalid_value in [None, ""]:
-            if invalid_value in users:
-                users.remove(invalid_value)
+        from .access import build_access_index
+
+        index = build_access_index(self, self.permission, self.groupBy)
 
-        self.permitted_users = list(users)
+        self.permitted_users = list(index)
         self.save()
+
+
+class DatalabSnapshot(Document):
+    # Cascade delete if the DataLab is deleted
+    datalab = ReferenceField(Datalab, required=True, reverse_delete_rule=2)
+    version = StringField(required=True)
+    # Compressed, pickled DataFrame of the built table, stored in GridFS as it
+    # can easily exceed the document size limit
+    data = FileField()
+    built_at = DateTimeField(default=dt.utcnow)
+
+    meta = {"indexes": ["datalab"]}
+
+
+class DatalabBuildLock(Document):
+    """ Held by the process which is building a snapshot of a DataLab, so that
+        other processes wait for its snapshot rather than building their own """
+
+    # Cascade delete if the DataLab is deleted
+    datalab = ReferenceField(
+        Datalab, required=True, unique=True, reverse_delete_rule=2
+    )
+    version = StringField(required=True)
+    owner = StringField(required=True)
+    # The lock is disregarded after this time, in case its owner was lost
+    expires = DateTimeField(required=True)
+
+
+class DatalabAccessIndex(Document):
+    """ Inverted index of the permission values of a DataLab's relations table,
+        as built by access.build_access_index. The index is only complete once
+        all of its entries have been written. It is inserted before its entries
+        are written, so that it also acts as the claim of the process building
+        it, and other processes wait for its entries rather than building their
+        own """
+
+    # Cascade delete if the DataLab is deleted
+    datalab = ReferenceField(Datalab, required=True, reverse_delete_rule=2)
+    permission = StringField(required=True)
+    group_by = StringField(null=True)
+    # Hash of the relations table that the index was built from
+    version = StringField(required=True)
+    # Whether the group_by field is a column of the relations table, and is
+    # therefore included in the entries
+    grouped = BooleanField(default=False)
+    complete = BooleanField(default=False)
+    built_at = DateTimeField(default=dt.utcnow)
+    # The process building the index, and when its claim may be taken over in
+    # case it was lost before completing the index
+    owner = StringField()
+    expires = DateTimeField()
+    # When the relations table of the DataLab last changed away from the version
+    # of this index, after which it is kept for a grace period
+    superseded_at = DateTimeField(null=True)
+
+    meta = {
+        "indexes": [
+            {
+                "fields": ["datalab", "permission", "group_by", "version"],
+                "unique": True,
+            }
+        ]
+    }
+
+
+class DatalabAccessEntry(Document):
+    # Cascade delete if the index is deleted
+    index = ReferenceField(DatalabAccessIndex, required=True, reverse_delete_rule=2)
+    # Lowercased permission value
+    value = StringField(required=True)
+    # Positions of the records with this permission value in the relations table
+    rows = ListField(IntField())
+    # Value of the group_by field of the first of these records
+    group = DynamicField(null=True)
+
+    meta = {"indexes": [("index", "value")]}
@@ -0,0 +1,114 @@
+""" Identity map of the datasources, DataLabs and forms referenced by modules.
+
+    The datasource module of a DataLab can refer to either a datasource or another
+    DataLab, so resolving a module previously meant querying both collections.
+    A resolver loads every datasource, DataLab and form referenced by a list of
+    steps with a single query per collection, and remembers which kind each id
+    is. A resolver is opened for the duration of each request and Celery task, so
+    that every lookup within that scope shares the same documents. """
+
+from bson.objectid import ObjectId
+import threading
+
+from datasource.models import Datasource
+from form.models import Form
+
+from .models import Datalab
+
+_scope = threading.local()
+
+
+class ModuleResolver:
+    def __init__(self):
+        # Maps ids to their document, or to None if the id does not exist
+        self._modules = {}
+        self._forms = {}
+
+    def prefetch(self, steps):
+        """ Loads every datasource, DataLab and form referenced by a list of steps,
+            which can be either Module documents or their dict representation """
+        module_ids = set()
+        form_ids = set()
+
+        for step in steps:
+            if step["type"] == "datasource":
+                module_ids.add(step["datasource"]["id"])
+            elif step["type"] == "form":
+                form_ids.add(step["form"])
+
+        self._load_modules(module_ids)
+        self._load_forms(form_ids)
+
+    def _missing(self, ids, loaded):
+        return {str(id) for id in ids if id and str(id) not in loaded}
+
+    def _load_modules(self, ids):
+        missing = self._missing(ids, self._modules)
+        valid_ids = [ObjectId(id) for id in missing if ObjectId.is_valid(id)]
+
+        if valid_ids:
+            for datasource in Datasource.objects(id__in=valid_ids):
+                self._modules[str(datasource.id)] = datasource
+
+        # Only ids that are not datasources can refer to DataLabs
+        valid_ids = [id for id in valid_ids if str(id) not in self._modules]
+        if valid_ids:
+            for datalab in Datalab.objects(id__in=valid_ids):
+                self._modules[str(datalab.id)] = datalab
+
+        for id in missing:
+            self._modules.setdefault(id, None)
+
+    def _load_forms(self, ids):
+        missing = self._missing(ids, self._forms)
+        valid_ids = [ObjectId(id) for id in missing if ObjectId.is_valid(id)]
+
+        if valid_ids:
+            for form in Form.objects(id__in=valid_ids):
+                self._forms[str(form.id)] = form
+
+        for id in missing:
+            self._forms.setdefault(id, None)
+
+    def module(self, id):
+        """ Returns the datasource or DataLab with the given id, or None """
+        self._load_modules([id])
+        return self._modules.get(str(id))
+
+    def form(self, id):
+        self._load_forms([id])
+        return self._forms.get(str(id))
+
+    def forget(self, id):
+        """ Discards a document which has been modified within the scope """
+        self._modules.pop(str(id), None)
+        self._forms.pop(str(id), None)
+
+
+def open_scope():
+    _scope.resolver = ModuleResolver()
+
+
+def close_scope():
+    _scope.resolver = None
+
+
+def get_resolver():
+    """ Returns the resolver of the current request or task. Outside of a scope,
+        a new resolver is returned which the caller should hold on to """
+    resolver = getattr(_scope, "resolver", None)
+    return resolver if resolver is not None else ModuleResolver()
+
+
+class ModuleResolverMiddleware:
+    """ Opens a resolver for the duration of each request """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        open_scope()
+        try:
+            return self.get_response(request)
+        finally:
+            close_scope()
@@ -8,31 +8,31 @@ from .models import Datalab, Column
 from datasource.models import Datasource
 from form.models import Form
 from form.serializers import FormSerializer
-from workflow.models import Workflow, EmailJob, Email
+from workflow.models import Workflow, EmailJob
+from helpers.serializers import ExpandableFieldsMixin
 
-
-class EmailSerializer(EmbeddedDocumentSerializer):
-    class Meta:
-        model = Email
-        exclude = ["content"]
+from .resolver import get_resolver
 
 
-class EmailJobSerializer(EmbeddedDocumentSerializer):
-    emails = EmailSerializer(many=True, allow_null=True, read_only=True)
-
+class EmailJobSerializer(DocumentSerializer):
     class Meta:
         model = EmailJob
-        fields = "__all__"
+        exclude = ["id", "action", "failures"]
 
 
 class ActionSerializer(DocumentSerializer):
-    emailJobs = EmailJobSerializer(many=True, allow_null=True, read_only=True)
+    emailJobs = serializers.SerializerMethodField()
     emailField = serializers.SerializerMethodField()
 
     class Meta:
         model = Workflow
         fields = ["id", "name", "emailJobs", "emailField"]
 
+    def get_emailJobs(self, action):
+        # Only the details of each job are needed, not the emails that were sent
+        serializer = EmailJobSerializer(action.get_email_jobs(), many=True)
+        return serializer.data
+
     def get_emailField(self, action):
         if "emailSettings" in action:
             return action.emailSettings.field
@@ -50,28 +50,16 @@ class OrderItemSerializer(EmbeddedDocumentSerializer):
     details = serializers.SerializerMethodField()
 
     def get_details(self, order_item):
-        if not "objects" in self.context:
-            self.context["objects"] = {}
+        # The resolver is shared by every order item, and by the rest of the request
+        resolver = self.context.setdefault("resolver", get_resolver())
+        resolver.prefetch(self.context["steps"])
 
         module = self.context["steps"][order_item.stepIndex]
 
         details = {"label": order_item.field, "module_type": module.type}
 
         if module.type == "datasource":
-            if module.datasource.id in self.context["objects"]:
-                datasource = self.context["objects"][module.datasource.id]
-            else:
-                try:
-                    datasource = Datasource.objects.get(id=module.datasource.id)
-                except:
-                    pass
-
-                try:
-                    datasource = Datalab.objects.get(id=module.datasource.id)
-                except:
-                    pass
-
-                self.context["objects"][module.datasource.id] = datasource
+            datasource = resolver.module(module.datasource.id)
 
             details["from"] = datasource.name
             details["label"] = module.datasource.labels.get(order_item.field)
@@ -84,11 +72,7 @@ class OrderItemSerializer(EmbeddedDocumentSerializer):
                 ).stepIndex
                 form_module_id = datasource.steps[form_module_index].form
 
-                if form_module_id in self.context["objects"]:
-                    form = self.context["objects"][form_module_id]
-                else:
-                    form = Form.objects.get(id=form_module_id)
-                    self.context["objects"][form_module_id] = form
+                form = resolver.form(form_module_id)
 
                 details["from"] = form.name
                 for field in form.fields:
@@ -105,11 +89,7 @@ class OrderItemSerializer(EmbeddedDocumentSerializer):
                             ]
 
         elif module.type == "form":
-            if module.form in self.context["objects"]:
-                form = self.context["objects"][module.form]
-            else:
-                form = Form.objects.get(id=module.form)
-                self.context["objects"][module.form] = form
+            form = resolver.form(module.form)
 
             details["from"] = form.name
             for field in form.fields:
@@ -159,7 +139,11 @@ class OtherDatalabSerializer(DocumentSerializer):
         fields = ["id", "name", "columns"]
 
 
-class DatalabSerializer(DocumentSerializer):
+class DatalabSerializer(ExpandableFieldsMixin, DocumentSerializer):
+    # Building the data of the DataLab, and serializing the other modules in its
+    # container, are only done when requested
+    expandable_fields = ["data", "datasources", "dataLabs", "forms", "actions"]
+
     datasources = serializers.SerializerMethodField()
     dataLabs = serializers.SerializerMethodField()
     forms = serializers.SerializerMethodField()
@@ -194,7 +178,29 @@ class DatalabSerializer(DocumentSerializer):
 
     class Meta:
         model = Datalab
-        fields = "__all__"
+        exclude = ["relationsRequest"]
+        read_only_fields = ["relationsVersion"]
+
+
+class DatalabColumnsSerializer(DocumentSerializer):
+    """ Column metadata of a DataLab, returned when its columns are modified """
+
+    columns = serializers.SerializerMethodField()
+
+    def get_columns(self, datalab):
+        return OrderItemSerializer(
+            datalab.order, many=True, context={"steps": datalab.steps}
+        ).data
+
+    class Meta:
+        model = Datalab
+        fields = ["id", "order", "columns"]
+
+
+class DatalabChartsSerializer(DocumentSerializer):
+    class Meta:
+        model = Datalab
+        fields = ["id", "charts"]
 
 
 class RestrictedDatalabSerializer(DocumentSerializer):
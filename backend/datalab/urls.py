@@ -3,6 +3,7 @@ from .views import *
 
 urlpatterns = [
     path("<id>/access/", AccessDataLab),
+    path("<id>/data/", DatalabData),
     path("<id>/csv/", ExportToCSV),
     path("create/", CreateDataLab)
 ]
@@ -11,13 +11,17 @@ from workflow.models import Workflow
 from form.models import Form
 from datalab.serializers import OtherDatalabSerializer
 
+from .resolver import get_resolver
+
 
 def bind_column_types(steps):
+    resolver = get_resolver()
+    resolver.prefetch(steps)
+
     for step in steps:
         if step["type"] == "datasource":
             step = step["datasource"]
-            datasource = None
-            datalab = None
+            module = None
             datalab_fields = None
 
             fields = step["fields"]
@@ -25,25 +29,18 @@ def bind_column_types(steps):
 
             for field in fields:
                 if field not in types:
-                    if not datasource:
-                        try:
-                            datasource = Datasource.objects.get(id=step["id"])
-                        except:
-                            pass
-
-                    if datasource:
-                        types[field] = datasource["types"][field]
-
-                    if not datalab:
-                        try:
-                            datalab = Datalab.objects.get(id=step["id"])
-                            datalab_fields = OtherDatalabSerializer(datalab).data[
-                                "columns"
-                            ]
-                        except:
-                            pass
-
-                    if datalab and datalab_fields:
+                    if not module:
+                        module = resolver.module(step["id"])
+
+                    if isinstance(module, Datasource):
+                        types[field] = module["types"][field]
+
+                    if isinstance(module, Datalab) and not datalab_fields:
+                        datalab_fields = OtherDatalabSerializer(
+                            module, context={"resolver": resolver}
+                        ).data["columns"]
+
+                    if datalab_fields:
                         for datalab_field in datalab_fields:
                             if datalab_field["details"]["label"] == field:
                                 types[field] = datalab_field["details"]["field_type"]
@@ -70,144 +67,207 @@ def bind_column_types(steps):
     return steps
 
 
-def calculate_computed_field(formula, record, build_fields, tracking_feedback_data):
-    calculated_value = 0
+def cast_float(value):
+    try:
+        return float(value) if not pd.isna(value) else 0
+    except (ValueError, TypeError) as Error:
+        return 0
 
-    populated_formula = []
 
-    def cast_float(value):
-        try:
-            return float(value) if not pd.isna(value) else 0
-        except (ValueError, TypeError) as Error:
-            return 0
+def cast_float_column(values):
+    """ Applies cast_float to every value of a column """
+    if values.dtype.kind in "biuf":
+        return values.astype(float).fillna(0).values
 
-    def tracking_feedback_value(action_id, job_id, data_type, record):
-        email_field = tracking_feedback_data[action_id]["email_field"]
-        data = tracking_feedback_data[action_id]["jobs"][job_id][data_type]
-        return (
-            data[record[email_field]]
-            if email_field in record and record[email_field] in data
-            else 0
-        )
+    return np.array([cast_float(value) for value in values.tolist()], dtype=float)
 
-    def iterate_aggregation(columns, is_numerical=True):
-        values = []
+
+def compile_computed_field(formula, build_fields):
+    """ Compiles a computed field formula into a function which evaluates the
+        formula over every record of a DataFrame in a single pass. The formula is
+        parsed once, rather than once per record, but the results are the same as
+        populating and evaluating the formula against each record individually """
+
+    nodes = formula["document"]["nodes"]
+
+    def aggregation_fields(columns):
+        fields = []
 
         for column in columns:
             split_column = column.split("_")
 
+            # Tracking and feedback data is not currently made available to
+            # computed fields, therefore these columns do not contribute values
             if split_column[0] in ["tracking", "feedback"]:
-                data_type = split_column[0]
-
-                if len(split_column) == 1:
-                    for action in tracking_feedback_data:
-                        for email_job in tracking_feedback_data[action]["jobs"]:
-                            values.append(
-                                tracking_feedback_value(
-                                    action, email_job, data_type, record
-                                )
-                            )
-
-                if len(split_column) == 2:
-                    action_id = split_column[1]
-                    for email_job in tracking_feedback_data[action_id]["jobs"]:
-                        values.append(
-                            tracking_feedback_value(
-                                action_id, email_job, data_type, record
-                            )
-                        )
-
-                if len(split_column) == 3:
-                    action_id = split_column[1]
-                    job_id = split_column[2]
-                    values.append(
-                        tracking_feedback_value(action_id, job_id, data_type, record)
-                    )
+                continue
 
-            else:
-                if len(split_column) == 1:
-                    step_index = int(split_column[0])
-                    for field in build_fields[step_index]:
-                        value = record[field] if field in record else None
-                        values.append(cast_float(value) if is_numerical else value)
-
-                elif len(split_column) == 2:
-                    step_index, field_index = [int(i) for i in split_column]
-                    field = build_fields[step_index][field_index]
-                    value = record[field] if field in record else None
-                    values.append(cast_float(value) if is_numerical else value)
-
-        return values
-
-    # Populate values on first pass-through
-    for node in formula["document"]["nodes"]:
+            if len(split_column) == 1:
+                step_index = int(split_column[0])
+                fields.extend(build_fields[step_index])
+
+            elif len(split_column) == 2:
+                step_index, field_index = [int(i) for i in split_column]
+                fields.append(build_fields[step_index][field_index])
+
+        return fields
+
+    def raw_column(data, field):
+        return data[field].tolist() if field in data else [None] * len(data)
+
+    def numerical_column(data, field):
+        return (
+            cast_float_column(data[field]) if field in data else np.zeros(len(data))
+        )
+
+    def list_aggregation(fields):
+        def evaluate(data):
+            columns = [raw_column(data, field) for field in fields]
+            if not columns:
+                return pd.Series([[] for i in range(len(data))], index=data.index)
+
+            return pd.Series(
+                [list(values) for values in zip(*columns)], index=data.index
+            )
+
+        return evaluate
+
+    def concat_aggregation(fields, delimiter):
+        # Join values even if they are null, as this would be the expected
+        # functionality if the user is trying to construct a .csv
+        # I.e. the number of delimiters should be constant for all rows
+        # Regardless of whether a given column has a value or not
+        def evaluate(data):
+            columns = [raw_column(data, field) for field in fields]
+            if not columns:
+                return pd.Series(["" for i in range(len(data))], index=data.index)
+
+            return pd.Series(
+                [
+                    delimiter.join([str(x) if x is not None else "" for x in values])
+                    for values in zip(*columns)
+                ],
+                index=data.index,
+            )
+
+        return evaluate
+
+    def last_aggregation(fields):
+        def evaluate(data):
+            if not fields:
+                return pd.Series([None] * len(data), index=data.index)
+
+            return pd.Series(raw_column(data, fields[-1]), index=data.index)
+
+        return evaluate
+
+    expression = []
+    operands = []
+
+    for node in nodes:
         node_type = node["type"]
 
         if node_type == "open-bracket":
-            populated_formula.append("(")
+            expression.append("(")
 
         if node_type == "close-bracket":
-            populated_formula.append(")")
+            expression.append(")")
 
         if node_type == "operator":
-            populated_formula.append(node["data"]["type"])
+            expression.append(node["data"]["type"])
 
         if node_type == "field":
-            field = node["data"]["name"]
-            populated_formula.append(cast_float(record[field]))
+            operands.append(("field", node["data"]["name"]))
+            expression.append(f"operand_{len(operands) - 1}")
 
         if node_type == "aggregation":
             aggregation_type = node["data"]["type"]
-            columns = node["data"]["columns"]
-            aggregation_value = 0
+            fields = aggregation_fields(node["data"]["columns"])
+
+            # Non-numerical aggregations take over the entire formula
+            if aggregation_type == "list":
+                return list_aggregation(fields)
+
+            if aggregation_type == "concat":
+                return concat_aggregation(fields, node["data"]["delimiter"])
+
+            # If the number of nodes is 2, then the aggregation is standalone
+            # It's 2 and not 1, because Slate.js blockmap always starts with a paragraph block
+            if aggregation_type == "last" and not len(nodes) > 2:
+                return last_aggregation(fields)
 
-            if aggregation_type == "sum":
-                aggregation_value = sum(iterate_aggregation(columns))
+            operands.append((aggregation_type, fields))
+            expression.append(f"operand_{len(operands) - 1}")
 
-            if aggregation_type == "average":
-                values = iterate_aggregation(columns)
-                aggregation_value = sum(values) / len(values) if len(values) else 0
+    # Separate the tokens so that adjacent operands remain a syntax error
+    expression = " ".join(expression)
 
-            if aggregation_type == "last":
+    def evaluate(data):
+        operand_values = {}
+
+        for operand_index, (operand_type, operand) in enumerate(operands):
+            if operand_type == "field":
+                # A missing field is an error, as in the formula itself
+                values = cast_float_column(data[operand])
+
+            elif operand_type in ["sum", "average"]:
+                values = np.zeros(len(data))
+                for field in operand:
+                    values = values + numerical_column(data, field)
+                if operand_type == "average" and len(operand):
+                    values = values / len(operand)
+
+            elif operand_type == "last":
                 # If the "last" aggregation is part of a larger formula, then treat
                 # it as numerical, since it must be part of a computation
-                values = iterate_aggregation(columns, is_numerical=False)
-                # If the number of nodes is 2, then the aggregation is standalone
-                # It's 2 and not 1, because Slate.js blockmap always starts with a paragraph block
-                if len(formula["document"]["nodes"]) > 2:
-                    aggregation_value = cast_float(values[-1]) if len(values) else 0
-                else:
-                    return values[-1] if len(values) else None
+                values = (
+                    numerical_column(data, operand[-1])
+                    if len(operand)
+                    else np.zeros(len(data))
+                )
 
-            if aggregation_type == "list":
-                return iterate_aggregation(columns, is_numerical=False)
+            else:
+                values = np.zeros(len(data))
 
-            if aggregation_type == "concat":
-                delimiter = node["data"]["delimiter"]
-                aggregation_value = iterate_aggregation(columns, is_numerical=False)
-                # Join values even if they are null, as this would be the expected
-                # functionality if the user is trying to construct a .csv
-                # I.e. the number of delimiters should be constant for all rows
-                # Regardless of whether a given column has a value or not
-                return delimiter.join(
-                    [str(x) if x is not None else "" for x in aggregation_value]
-                )
+            operand_values[f"operand_{operand_index}"] = values
+
+        try:
+            result = ne.evaluate(expression, local_dict=operand_values)
+        except (ZeroDivisionError, AttributeError, TypeError, KeyError, SyntaxError):
+            return pd.Series([None] * len(data), index=data.index)
 
-            populated_formula.append(aggregation_value)
+        result = np.broadcast_to(result, (len(data),)).astype(float)
 
-    populated_formula = "".join([str(x) for x in populated_formula])
+        # Non-finite operands (e.g. "inf" strings or overflowing sums) could not be
+        # evaluated when formulas were populated as strings, and division by zero
+        # raised an error, so neither yields a value
+        is_finite = np.isfinite(result)
+        for values in operand_values.values():
+            is_finite &= np.isfinite(values)
+        result = np.where(is_finite, result, np.nan)
 
-    try:
-        return ne.evaluate(populated_formula).item()
-    except (ZeroDivisionError, AttributeError, TypeError, KeyError, SyntaxError):
-        return None
+        return pd.Series(result, index=data.index)
+
+    return evaluate
+
+
+def load_module_data(module, primary, fields):
+    """ Loads only the primary key and the given fields of the datasource or DataLab
+        used by a module, indexed by the primary key """
+    columns = [primary] + [field for field in fields if field != primary]
+    return module.load_data(columns).set_index(primary)
 
 
-def get_relations(steps, datalab_id=None, skip_last=False, permission=None):
+def get_relations(
+    steps, datalab_id=None, skip_last=False, permission=None, group_by=None
+):
     required_fields = set()
 
+    # The permission and group by fields are included so that access to the
+    # records can be indexed without building the DataLab
     if permission:
         required_fields.add(permission)
+    if group_by:
+        required_fields.add(group_by)
 
     # Identify the fields used in any associated forms or actions
     if datalab_id:
@@ -215,6 +275,8 @@ def get_relations(steps, datalab_id=None, skip_last=False, permission=None):
         for form in forms:
             required_fields.add(form.primary)
             required_fields.add(form.permission)
+            if form.groupBy:
+                required_fields.add(form.groupBy)
 
     # Identify the fields used as matching keys for datasource modules
     datasource_steps = [
@@ -232,17 +294,12 @@ def get_relations(steps, datalab_id=None, skip_last=False, permission=None):
     if skip_last:
         datasource_steps = datasource_steps[:-1]
 
+    resolver = get_resolver()
+    resolver.prefetch(steps)
+
     relations = pd.DataFrame()
     for step_index, step in enumerate(datasource_steps):
-        try:
-            datasource = Datasource.objects.get(id=step["id"])
-        except:
-            pass
-
-        try:
-            datasource = Datalab.objects.get(id=step["id"])
-        except:
-            pass
+        datasource = resolver.module(step["id"])
 
         # If this datasource has fields that are used by forms, actions, or datasources,
         # then ensure that these fields are included in the relation table
@@ -252,9 +309,8 @@ def get_relations(steps, datalab_id=None, skip_last=False, permission=None):
                 used_fields.append(field)
 
         data = (
-            pd.DataFrame(data=datasource.data)
-            .set_index(step["primary"])
-            .filter(items=used_fields)  # Only include required fields
+            # Only load the primary key and required fields
+            load_module_data(datasource, step["primary"], used_fields)
             .rename(columns={field: step["labels"][field] for field in used_fields})
         )
 
@@ -292,3 +348,63 @@ def get_relations(steps, datalab_id=None, skip_last=False, permission=None):
     relations.replace({pd.np.nan: None}, inplace=True)
 
     return relations.to_dict("records")
+
+
+def sort_key(values):
+    """ Key by which a column is sorted: numerically if every value is a number,
+        otherwise case-insensitively by its text """
+    numeric = pd.to_numeric(values, errors="coerce")
+    if numeric.notnull().sum() == values.notnull().sum():
+        return numeric
+
+    def text(value):
+        if isinstance(value, list):
+            return ",".join(str(item) for item in value).lower()
+
+        return None if pd.isnull(value) else str(value).lower()
+
+    return values.map(text)
+
+
+def matches_filter(value, accepted):
+    if isinstance(value, list):
+        return any(str(item) in accepted for item in value)
+
+    return str(value) in accepted
+
+
+def query_data(data, sort=None, descending=False, filters=None, search=None):
+    """ Filters, searches and sorts the built table of a DataLab.
+
+        filters maps columns to a list of accepted values, and search matches any
+        record containing the given text (case-insensitive) in any column """
+    if filters:
+        for column, accepted in filters.items():
+            if column not in data or not accepted:
+                continue
+
+            accepted = set(str(value) for value in accepted)
+            data = data[
+                data[column].map(lambda value: matches_filter(value, accepted))
+            ]
+
+    if search:
+        search = search.lower()
+        mask = np.zeros(len(data), dtype=bool)
+        for column in data:
+            mask |= (
+                data[column]
+                .map(lambda value: value is not None and search in str(value).lower())
+                .values
+            )
+        data = data[mask]
+
+    if sort and sort in data:
+        index = (
+            sort_key(data[sort])
+            .sort_values(ascending=not descending, kind="mergesort", na_position="last")
+            .index
+        )
+        data = data.loc[index]
+
+    return data
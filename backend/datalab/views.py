@@ -21,25 +21,44 @@ from .serializers import (
     DatalabSerializer,
     OrderItemSerializer,
     RestrictedDatalabSerializer,
+    DatalabColumnsSerializer,
+    DatalabChartsSerializer,
 )
 from .permissions import DatalabPermissions
-from .models import Datalab
-from .utils import bind_column_types, get_relations
+from .models import Datalab, Chart
+from .utils import bind_column_types, get_relations, query_data
+from .cache import invalidate_snapshot
+from .access import permission_values, find_records, relations_version
+from .dependencies import propagate_change
+from .resolver import get_resolver
 
 from container.models import Container
+from accounts.models import lti
 from datasource.models import Datasource
-from form.models import Form
 
 import logging
 
 logger = logging.getLogger("ontask")
 
+# Number of records returned per page of DataLab data, unless requested otherwise
+DATA_PAGE_SIZE = 50
+
 
 class DatalabViewSet(viewsets.ModelViewSet):
     lookup_field = "id"
     serializer_class = DatalabSerializer
     permission_classes = [IsAuthenticated, DatalabPermissions]
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+
+        # The full DataLab is returned when it is opened, whereas lists and the
+        # responses of mutations are lean unless ?expand= is given
+        if self.action == "retrieve":
+            context["expand"] = ["all"]
+
+        return context
+
     def get_queryset(self):
         # Get the containers this user owns or has access to
         containers = Container.objects.filter(
@@ -71,9 +90,18 @@ class DatalabViewSet(viewsets.ModelViewSet):
                     }
                 )
 
-        relations = get_relations(steps, permission=self.request.data.get("permission"))
+        relations = get_relations(
+            steps,
+            permission=self.request.data.get("permission"),
+            group_by=self.request.data.get("groupBy"),
+        )
 
-        datalab = serializer.save(steps=steps, order=order, relations=relations)
+        datalab = serializer.save(
+            steps=steps,
+            order=order,
+            relations=relations,
+            relationsVersion=relations_version(relations),
+        )
         datalab.refresh_access()
 
         logger.info(
@@ -104,7 +132,7 @@ class DatalabViewSet(viewsets.ModelViewSet):
                 fields[step_index] = step["datasource"]["fields"]
 
             elif step["type"] == "form":
-                form_fields = Form.objects.get(id=step["form"]).fields
+                form_fields = get_resolver().form(step["form"]).fields
                 fields[step_index] = [field["name"] for field in form_fields]
 
             elif step["type"] == "computed":
@@ -139,12 +167,23 @@ class DatalabViewSet(viewsets.ModelViewSet):
                     order.append({"stepIndex": step_index, "field": field})
 
         relations = get_relations(
-            steps, datalab_id=datalab.id, permission=self.request.data.get("permission")
+            steps,
+            datalab_id=datalab.id,
+            permission=self.request.data.get("permission"),
+            group_by=self.request.data.get("groupBy"),
         )
 
-        datalab = serializer.save(steps=steps, order=order, relations=relations)
+        datalab = serializer.save(
+            steps=steps,
+            order=order,
+            relations=relations,
+            relationsVersion=relations_version(relations),
+        )
         datalab.refresh_access()
 
+        # Refresh the forms of this DataLab, and any DataLabs built from it
+        propagate_change("datalab", datalab.id)
+
         logger.info(
             "datalab.update",
             extra={"user": self.request.user.email, "payload": self.request.data},
@@ -152,6 +191,7 @@ class DatalabViewSet(viewsets.ModelViewSet):
 
     def perform_destroy(self, datalab):
         self.check_object_permissions(self.request, datalab)
+        invalidate_snapshot(datalab.id)
         datalab.delete()
 
         logger.info(
@@ -179,17 +219,12 @@ class DatalabViewSet(viewsets.ModelViewSet):
         data = get_relations(steps, datalab_id=datalab_id, skip_last=True)
 
         check_module = steps[-1]["datasource"]
-        try:
-            datasource = Datasource.objects.get(id=check_module["id"])
-        except:
-            pass
+        datasource = get_resolver().module(check_module["id"])
 
-        try:
-            datasource = Datalab.objects.get(id=check_module["id"])
-        except:
-            pass
-
-        primary_records = {item[check_module["primary"]] for item in datasource.data}
+        primary = datasource.load_data([check_module["primary"]])[
+            check_module["primary"]
+        ]
+        primary_records = set(primary.astype(object).where(pd.notnull(primary), None))
         matching_records = {
             item[check_module["matching"]]
             for item in data
@@ -252,33 +287,33 @@ class DatalabViewSet(viewsets.ModelViewSet):
         datalab = self.get_object()
         self.check_object_permissions(self.request, datalab)
 
-        order = [
-            {
-                "stepIndex": item["stepIndex"],
-                "field": item["field"],
-                "visible": item["visible"],
-                "pinned": item["pinned"],
-            }
-            for item in datalab.order
-        ]
         drag_index = request.data["dragIndex"]
         hover_index = request.data["hoverIndex"]
 
+        order = list(datalab.order)
         field = order.pop(drag_index)
         order.insert(hover_index, field)
 
-        serializer = DatalabSerializer(
-            instance=datalab, data={"order": order}, partial=True
-        )
-        serializer.is_valid()
-        serializer.save()
+        Datalab.objects(id=datalab.id).update_one(set__order=order)
+        datalab.order = order
 
         logger.info(
             "datalab.reorder_columns",
             extra={"user": self.request.user.email, "payload": self.request.data},
         )
 
-        return JsonResponse(serializer.data)
+        # Only the column metadata is returned, which the client merges into the
+        # DataLab it already has
+        return JsonResponse(DatalabColumnsSerializer(datalab).data)
+
+    def update_column(self, datalab, column_index, attribute, value):
+        if not 0 <= column_index < len(datalab.order):
+            raise ValidationError("Invalid column")
+
+        Datalab._get_collection().update_one(
+            {"_id": datalab.id},
+            {"$set": {f"order.{column_index}.{attribute}": value}},
+        )
 
     @detail_route(methods=["patch"])
     def change_column_visibility(self, request, id=None):
@@ -288,22 +323,7 @@ class DatalabViewSet(viewsets.ModelViewSet):
         column_index = request.data["columnIndex"]
         visible = request.data["visible"]
 
-        order = [
-            {
-                "stepIndex": item["stepIndex"],
-                "field": item["field"],
-                "visible": item["visible"],
-                "pinned": item["pinned"],
-            }
-            for item in datalab.order
-        ]
-        order[column_index]["visible"] = visible
-
-        serializer = DatalabSerializer(
-            instance=datalab, data={"order": order}, partial=True
-        )
-        serializer.is_valid()
-        serializer.save()
+        self.update_column(datalab, column_index, "visible", bool(visible))
 
         logger.info(
             "datalab.change_column_visibility",
@@ -320,22 +340,7 @@ class DatalabViewSet(viewsets.ModelViewSet):
         column_index = request.data["columnIndex"]
         pinned = request.data["pinned"]
 
-        order = [
-            {
-                "stepIndex": item["stepIndex"],
-                "field": item["field"],
-                "visible": item["visible"],
-                "pinned": item["pinned"],
-            }
-            for item in datalab.order
-        ]
-        order[column_index]["pinned"] = pinned
-
-        serializer = DatalabSerializer(
-            instance=datalab, data={"order": order}, partial=True
-        )
-        serializer.is_valid()
-        serializer.save()
+        self.update_column(datalab, column_index, "pinned", bool(pinned))
 
         logger.info(
             "datalab.change_column_pinned",
@@ -355,22 +360,31 @@ class DatalabViewSet(viewsets.ModelViewSet):
 
         module_type = datalab.steps[step_index].type
 
+        update = {}
         if module_type == "datasource":
-            datalab.steps[step_index].datasource.types[field_name] = field_type
+            types = datalab.steps[step_index].datasource.types
+            types[field_name] = field_type
+            # Field names can contain dots, so the types are set as a whole
+            update[f"steps.{step_index}.datasource.types"] = types
 
         elif module_type == "computed":
-            field = next(
+            field_index = next(
                 (
-                    field
-                    for field in datalab.steps[step_index].computed.fields
+                    field_index
+                    for field_index, field in enumerate(
+                        datalab.steps[step_index].computed.fields
+                    )
                     if field.name == field_name
                 ),
                 None,
             )
-            if field:
-                field.type = field_type
+            if field_index is not None:
+                update[
+                    f"steps.{step_index}.computed.fields.{field_index}.type"
+                ] = field_type
 
-        datalab.save()
+        if update:
+            Datalab._get_collection().update_one({"_id": datalab.id}, {"$set": update})
 
         logger.info(
             "datalab.update_column_type",
@@ -384,20 +398,16 @@ class DatalabViewSet(viewsets.ModelViewSet):
         datalab = self.get_object()
         self.check_object_permissions(self.request, datalab)
 
-        charts = datalab["charts"]
-
-        for i in range(len(charts)):
-            charts[i] = json.loads(charts[i].to_json())
-
-        charts.append(request.data)
+        try:
+            chart = Chart(**request.data)
+            chart.validate()
+        except Exception:
+            raise ValidationError("Invalid chart")
 
-        serializer = DatalabSerializer(
-            instance=datalab, data={"charts": charts}, partial=True
-        )
-        serializer.is_valid()
-        serializer.save()
+        Datalab.objects(id=datalab.id).update_one(push__charts=chart)
+        datalab.charts.append(chart)
 
-        return JsonResponse(serializer.data)
+        return JsonResponse(DatalabChartsSerializer(datalab).data)
 
     @detail_route(methods=["post"])
     def clone_datalab(self, request, id=None):
@@ -420,6 +430,40 @@ class DatalabViewSet(viewsets.ModelViewSet):
         return JsonResponse({"success": 1})
 
 
+def restrict_data(datalab, data, user):
+    """ Restricts the built table of a DataLab to what a user without full
+        permission may see, returning the records along with the user's default
+        group. Raises PermissionDenied if the user has no records """
+    user_values = permission_values(datalab, user)
+    records = find_records(datalab, datalab.permission, user_values, datalab.groupBy)
+
+    if not records.rows:
+        # User does not have access to any records, so return a 403
+        raise PermissionDenied()
+
+    if len(data) == len(datalab.relations):
+        # The built table has a record for each record of the relations table
+        accessible_records = data.iloc[records.rows]
+    else:
+        accessible_records = data[
+            data[datalab.permission].str.lower().isin(user_values)
+        ]
+
+    if datalab.restriction == "private":
+        data = accessible_records
+
+    if records.grouped:
+        default_group = records.default_group
+    else:
+        default_group = (
+            accessible_records[datalab.groupBy].iloc[0]
+            if datalab.groupBy and len(accessible_records)
+            else None
+        )
+
+    return data, default_group
+
+
 @api_view(["GET"])
 def AccessDataLab(request, id):
     try:
@@ -428,34 +472,11 @@ def AccessDataLab(request, id):
         raise NotFound()
 
     if datalab.container.has_full_permission(request.user):
-        serializer = DatalabSerializer(datalab)
+        serializer = DatalabSerializer(datalab, context={"expand": ["all"]})
         return Response(serializer.data)
 
-    user_values = []
-    if datalab.emailAccess:
-        user_values.append(request.user.email.lower())
-    if datalab.ltiAccess:
-        try:
-            lti_object = lti.objects.get(user=request.user.id)
-            user_values.extend([value.lower() for value in lti_object.payload.values()])
-        except:
-            pass
+    data, default_group = restrict_data(datalab, datalab.frame, request.user)
 
-    data = pd.DataFrame(data=datalab.data)
-    accessible_records = data[data[datalab.permission].str.lower().isin(user_values)]
-
-    if not len(accessible_records):
-        # User does not have access to any records, so return a 403
-        raise PermissionDenied()
-
-    if datalab.restriction == "private":
-        data = accessible_records
-
-    default_group = (
-        accessible_records[datalab.groupBy].iloc[0] if datalab.groupBy else None
-    )
-
-    data.replace({pd.np.nan: None}, inplace=True)
     serializer = RestrictedDatalabSerializer(
         datalab,
         context={"data": data.to_dict("records"), "default_group": default_group},
@@ -469,6 +490,52 @@ def AccessDataLab(request, id):
     return Response(serializer.data)
 
 
+@api_view(["GET"])
+def DatalabData(request, id):
+    """ A single page of the built table of a DataLab, after the filters, search
+        and sort given in the query parameters are applied """
+    try:
+        datalab = Datalab.objects.get(id=id)
+    except:
+        raise NotFound()
+
+    data = datalab.frame
+    default_group = None
+    if not datalab.container.has_full_permission(request.user):
+        data, default_group = restrict_data(datalab, data, request.user)
+
+    params = request.query_params
+    try:
+        page = max(int(params.get("page", 1)), 1)
+        page_size = min(max(int(params.get("page_size", DATA_PAGE_SIZE)), 1), 1000)
+        filters = json.loads(params.get("filters", "{}"))
+    except ValueError:
+        raise ValidationError("Invalid pagination or filter parameters")
+
+    unfiltered_total = len(data)
+    data = query_data(
+        data,
+        sort=params.get("sort"),
+        descending=params.get("order") in ["desc", "descend"],
+        filters=filters if isinstance(filters, dict) else None,
+        search=params.get("search"),
+    )
+
+    records = data.iloc[(page - 1) * page_size : page * page_size]
+    records = records.astype(object).where(pd.notnull(records), None)
+
+    return Response(
+        {
+            "data": records.to_dict("records"),
+            "total": len(data),
+            "unfilteredTotal": unfiltered_total,
+            "page": page,
+            "page_size": page_size,
+            "default_group": default_group,
+        }
+    )
+
+
 @api_view(["POST"])
 def ExportToCSV(request, id):
     try:
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from datasource.models import Datasource
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the data stored in datasource documents into the datasource storage "
+        "backend"
+    )
+
+    def handle(self, *args, **options):
+        migrated = 0
+        for datasource in Datasource.objects(
+            dataRevision=None, legacy_data__exists=True
+        ):
+            datasource.store_data(datasource.legacy_data)
+            migrated += 1
+
+        self.stdout.write(f"Migrated the data of {migrated} datasources")
@@ -8,6 +8,7 @@ from mongoengine.fields import (
     EmbeddedDocumentField,
     EmbeddedDocumentListField,
     DateTimeField,
+    BinaryField,
 )
 from datetime import datetime as dt
 import pandas as pd
@@ -22,6 +23,7 @@ from .utils import (
     process_data,
 )
 
+
 class File(EmbeddedDocument):
     name = StringField()
     delimiter = StringField()
@@ -69,13 +71,80 @@ class Datasource(Document):
     container = ReferenceField(Container, required=True, reverse_delete_rule=2)
     name = StringField(required=True)
     connection = EmbeddedDocumentField(Connection)
-    data = ListField(DictField())
+    # Data stored in the document itself, before the storage backends were used
+    legacy_data = ListField(DictField(), db_field="data")
+    # Revision of the table of this datasource in the storage backend
+    dataRevision = StringField(null=True)
+    # Revision which the current one replaced, kept until the next write
+    previousRevision = StringField(null=True)
     schedule = EmbeddedDocumentField(Schedule, null=True)
     # Last time the data was updated
     lastUpdated = DateTimeField(default=dt.utcnow)
     fields = ListField(StringField())
     types = DictField()
 
+    def load_data(self, columns=None):
+        """ Loads the table of this datasource as a DataFrame. If a list of columns
+            is given, then only those columns are read from storage """
+        if not self.dataRevision:
+            data = pd.DataFrame(data=self.legacy_data)
+            return data if columns is None else data.filter(items=columns)
+
+        from .storage import get_storage
+
+        return get_storage().read(self, self.dataRevision, columns)
+
+    @property
+    def data(self):
+        data = self.load_data()
+        return data.astype(object).where(pd.notnull(data), None).to_dict("records")
+
+    def store_data(self, data):
+        """ Writes a list of records to the storage backend and points this
+            datasource to them. The table being replaced is kept until the next
+            write, as requests which loaded this datasource before may still be
+            reading it, and the table that it replaced is removed instead.
+
+            The revisions and lastUpdated are written here rather than by save(),
+            so that a later save() of this datasource cannot revert them """
+        from .storage import get_storage
+        from datalab.resolver import get_resolver
+
+        storage = get_storage()
+        revision = storage.write(self, data)
+
+        # The revisions are swapped only if no other write has done so since they
+        # were read, so that every replaced revision is removed exactly once
+        while True:
+            current = (
+                Datasource.objects(id=self.id)
+                .only("dataRevision", "previousRevision")
+                .first()
+            )
+            if current is None:
+                # The datasource was deleted while its table was being written
+                storage.delete(self, revision)
+                return
+
+            swapped = Datasource.objects(
+                id=self.id, dataRevision=current.dataRevision
+            ).update_one(
+                set__dataRevision=revision,
+                set__previousRevision=current.dataRevision,
+                set__lastUpdated=dt.utcnow(),
+                unset__legacy_data=True,
+            )
+            if swapped:
+                break
+
+        # Reloading the fields also removes them from the changed fields
+        self.reload("dataRevision", "previousRevision", "lastUpdated")
+
+        if current.previousRevision:
+            storage.delete(self, current.previousRevision)
+
+        get_resolver().forget(self.id)
+
     def retrieve_data(self, connection=None, file=None):
         if not connection:
             connection = self.connection
@@ -107,45 +176,35 @@ class Datasource(Document):
             "sqlite",
             "mssql",
         ]:
-            self.data = self.retrieve_data()
-            self.fields = [field for field in self.data[0]]
-            self.lastUpdated = dt.utcnow()
+            data = self.retrieve_data()
+            self.fields = [field for field in data[0]]
 
+            # The new table is stored along with lastUpdated, so that the DataLabs
+            # built from this datasource are never cached with stale data
+            self.store_data(data)
             self.save()
             self.update_associated_datalabs()
 
     def update_associated_datalabs(self):
-        from datalab.models import Datalab
-        from datalab.utils import get_relations
-        from form.models import Form
-
-        # Find any datalabs that use this datasource and update their relations table
-        # But only if any of the datasource's fields actually appears in the relations table
-        for datalab in Datalab.objects.filter(steps__datasource__id=str(self.id)):
-            relations = pd.DataFrame(datalab.relations)
-            if any([field in relations for field in self.fields]):
-                datalab.relations = get_relations(
-                    datalab.steps, datalab.id, permission=datalab.permission
-                )
-                datalab.save()
-                datalab.refresh_access()
-
-                # Find any other datalabs that use this datalab and update their relations table
-                for other_datalab in Datalab.objects.filter(
-                    steps__datasource__id=str(datalab.id)
-                ):
-                    other_datalab.relations = get_relations(
-                        other_datalab.steps,
-                        other_datalab.id,
-                        permission=other_datalab.permission,
-                    )
-                    other_datalab.save()
-                    other_datalab.refresh_access()
-
-                    # Find any forms that use the other datalab and update their permissions values
-                    for form in Form.objects.filter(datalab=other_datalab):
-                        form.refresh_access()
-
-                # Find any forms that use this datalab and update their permissions values
-                for form in Form.objects.filter(datalab=datalab):
-                    form.refresh_access()
+        """ Rebuilds the relations and access of every DataLab and form which
+            depends on this datasource, directly or through other DataLabs """
+        from datalab.dependencies import propagate_change
+
+        propagate_change("datasource", self.id)
+
+
+class DatasourceBlock(Document):
+    """ Compressed block of the values of a single column of a datasource table,
+        as written by storage.ColumnBlockStorage """
+
+    # Cascade delete if the datasource is deleted
+    datasource = ReferenceField(Datasource, required=True, reverse_delete_rule=2)
+    revision = StringField(required=True)
+    column = StringField(required=True)
+    # Position of the column in the table
+    position = IntField(required=True)
+    # Position of the block in the column
+    index = IntField(required=True)
+    values = BinaryField()
+
+    meta = {"indexes": [("datasource", "revision", "column")]}
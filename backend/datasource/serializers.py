@@ -1,9 +1,18 @@
+from rest_framework import serializers as drf_serializers
 from rest_framework_mongoengine import serializers
 
 from .models import Datasource
 
 
 class DatasourceSerializer(serializers.DocumentSerializer):
+    # The table of the datasource is kept in the storage backend
+    data = drf_serializers.SerializerMethodField()
+
+    def get_data(self, datasource):
+        return datasource.data
+
     class Meta:
         model = Datasource
-        fields = '__all__'
+        exclude = ["legacy_data"]
+        # The revisions are only changed by Datasource.store_data
+        read_only_fields = ["dataRevision", "previousRevision"]
@@ -0,0 +1,107 @@
+""" Storage backends for the tables of datasources.
+
+    The rows of a datasource are kept outside of the Datasource document, so that
+    loading or saving a datasource's metadata does not read or rewrite its data,
+    and so that datasources are not limited by the document size limit.
+
+    A backend writes a table under a new revision, which the datasource then
+    points to. The previous revision is kept until the next write, so that it can
+    still be read by requests in flight. Backends must be able to read a subset
+    of the columns of a table without reading the others. """
+
+from collections import OrderedDict
+from bson.objectid import ObjectId
+import pandas as pd
+import pickle
+import zlib
+
+from ontask.settings import DATASOURCE_STORAGE
+
+from .models import DatasourceBlock
+
+
+class TableStorage:
+    def write(self, datasource, data):
+        """ Stores a list of records, returning the revision of the stored table """
+        raise NotImplementedError
+
+    def read(self, datasource, revision, columns=None):
+        """ Reads the given columns (or all columns) of a stored table into a
+            DataFrame, in the order the columns were stored """
+        raise NotImplementedError
+
+    def delete(self, datasource, revision=None):
+        """ Removes a revision of a table, or every revision if none is given """
+        raise NotImplementedError
+
+
+class ColumnBlockStorage(TableStorage):
+    """ Stores each column of a table as compressed blocks of values in the
+        datasource_block collection. Only the blocks of the requested columns are
+        read, and the column name is stored once per block rather than once per
+        value as with a list of records """
+
+    # Number of values per block, which keeps even wide text columns well under
+    # the document size limit once compressed
+    block_size = 50000
+
+    def write(self, datasource, data):
+        frame = pd.DataFrame(data)
+        revision = str(ObjectId())
+        starts = range(0, max(len(frame), 1), self.block_size)
+
+        blocks = [
+            DatasourceBlock(
+                datasource=datasource,
+                revision=revision,
+                column=str(column),
+                position=position,
+                index=index,
+                values=zlib.compress(
+                    pickle.dumps(
+                        frame[column].iloc[start : start + self.block_size].tolist(),
+                        pickle.HIGHEST_PROTOCOL,
+                    )
+                ),
+            )
+            for position, column in enumerate(frame.columns)
+            for index, start in enumerate(starts)
+        ]
+
+        if blocks:
+            DatasourceBlock.objects.insert(blocks, load_bulk=False)
+
+        return revision
+
+    def read(self, datasource, revision, columns=None):
+        blocks = DatasourceBlock.objects(datasource=datasource.id, revision=revision)
+        if columns is not None:
+            blocks = blocks.filter(column__in=list(columns))
+
+        values = {}
+        positions = {}
+        for block in blocks.order_by("position", "index"):
+            values.setdefault(block.column, []).extend(
+                pickle.loads(zlib.decompress(block.values))
+            )
+            positions[block.column] = block.position
+
+        ordered = sorted(values, key=lambda column: positions[column])
+        return pd.DataFrame(
+            OrderedDict((column, values[column]) for column in ordered),
+            columns=ordered,
+        )
+
+    def delete(self, datasource, revision=None):
+        blocks = DatasourceBlock.objects(datasource=datasource.id)
+        if revision is not None:
+            blocks = blocks.filter(revision=revision)
+
+        blocks.delete()
+
+
+STORAGE_BACKENDS = {"column_blocks": ColumnBlockStorage}
+
+
+def get_storage():
+    return STORAGE_BACKENDS[DATASOURCE_STORAGE]()
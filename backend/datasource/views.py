@@ -9,9 +9,7 @@ from mongoengine.queryset.visitor import Q
 import json
 import boto3
 from xlrd import open_workbook
-from datetime import datetime as dt
 import os
-import pandas as pd
 
 from cryptography.fernet import Fernet
 from ontask.settings import SECRET_KEY
@@ -103,9 +101,8 @@ class DatasourceViewSet(viewsets.ModelViewSet):
         fields = list(data[0].keys())
         types = guess_column_types(data)
 
-        datasource = serializer.save(
-            connection=connection, data=data, fields=fields, types=types
-        )
+        datasource = serializer.save(connection=connection, fields=fields, types=types)
+        datasource.store_data(data)
 
         if "file" in self.request.data:
             logger.info(
@@ -184,12 +181,11 @@ class DatasourceViewSet(viewsets.ModelViewSet):
             fields = list(data[0].keys())
             types = guess_column_types(data)
 
+            # The new table is stored along with lastUpdated, so that the DataLabs
+            # built from this datasource are never cached with stale data
+            datasource.store_data(data)
             datasource = serializer.save(
-                connection=connection,
-                data=data,
-                fields=fields,
-                types=types,
-                lastUpdated=dt.utcnow(),
+                connection=connection, fields=fields, types=types
             )
             datasource.update_associated_datalabs()
         else:
@@ -314,10 +310,10 @@ class DatasourceViewSet(viewsets.ModelViewSet):
         response = HttpResponse(content_type="text/csv")
         response["Content-Disposition"] = f"attachment; filename={datasource.name}.csv"
         response["Access-Control-Expose-Headers"] = "Content-Disposition"
-        data = pd.DataFrame(datasource.data)
+        data = datasource.load_data()
 
         # Re-order the columns to match the original datasource data
-        data = data.reindex(columns=list(datasource.data[0].keys()))
+        data = data.reindex(columns=datasource.fields)
 
         data.to_csv(path_or_buf=response, index=False)
 
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from form.models import Form
+
+
+class Command(BaseCommand):
+    help = "Moves the responses stored in form documents into form records"
+
+    def handle(self, *args, **options):
+        migrated = 0
+        for form in Form.objects(legacy_data__not__size=0, legacy_data__exists=True):
+            form.migrate_legacy_data()
+            migrated += 1
+
+        self.stdout.write(f"Migrated the data of {migrated} forms")
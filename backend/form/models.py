@@ -9,11 +9,16 @@ from mongoengine.fields import (
     BooleanField,
     DateTimeField,
     FloatField,
+    DynamicField,
 )
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from container.models import Container
 from datalab.models import Datalab
 
+from .utils import encode_values, decode_values, record_update
+
 
 class Option(EmbeddedDocument):
     label = StringField(required=True)
@@ -59,18 +64,139 @@ class Form(Document):
     permission = StringField(null=True)
     groupBy = StringField(null=True)
     searchBy = ListField(StringField())
-    data = ListField(DictField())
+    # Responses stored in the document itself, before FormRecords were used
+    legacy_data = ListField(DictField(), db_field="data")
     permitted_users = ListField(StringField())
     restriction = StringField(choices=("private", "limited", "open"), default="private")
+    # Incremented whenever the data or design changes, which invalidates the
+    # snapshots of any DataLabs that use this form
+    revision = IntField(default=0)
+
+    def field_columns(self):
+        """ The columns of the form data other than the primary key, i.e. the
+            names of the fields and the columns of any checkbox-group fields """
+        columns = []
+        for field in self.fields:
+            if field.type == "checkbox-group":
+                columns.extend(field.columns)
+            else:
+                columns.append(field.name)
+
+        return columns
+
+    @property
+    def data(self):
+        """ The responses of the form as a list of records, which are read with
+            a single query on the (form, primary) index """
+        if self.legacy_data:
+            return self.legacy_data
+
+        return [
+            {self.primary: record["primary"], **decode_values(record.get("values", {}))}
+            for record in FormRecord._get_collection().find(
+                {"form": self.id}, {"_id": False, "primary": True, "values": True}
+            )
+        ]
+
+    def migrate_legacy_data(self):
+        """ Moves the responses stored in the document itself into FormRecords,
+            without overwriting any record that has already been written """
+        if not self.legacy_data:
+            return
+
+        operations = [
+            UpdateOne(
+                {"form": self.id, "primary": record[self.primary]},
+                {
+                    "$setOnInsert": {
+                        "values": encode_values(
+                            {
+                                field: value
+                                for field, value in record.items()
+                                if field != self.primary
+                            }
+                        )
+                    }
+                },
+                upsert=True,
+            )
+            for record in self.legacy_data
+            if record.get(self.primary) is not None
+        ]
+        if operations:
+            FormRecord._get_collection().bulk_write(operations, ordered=False)
+
+        Form.objects(id=self.id).update_one(unset__legacy_data=True)
+        self.legacy_data = []
+
+    def update_records(self, changes, revise=True):
+        """ Applies a list of (primary, values) changes to the responses of the
+            form, each of which is an atomic upsert of a single record. Only the
+            given fields of each record are changed, so concurrent edits of
+            other fields of the same record are preserved. Field names are
+            escaped (see utils.encode_field), as they may contain dots. Returns
+            the number of records that were inserted and updated. If revise is
+            False, then the revision of the form must be bumped by the caller """
+        self.migrate_legacy_data()
+
+        operations = [
+            UpdateOne(
+                {"form": self.id, "primary": primary},
+                {"$set": record_update(values)},
+                upsert=True,
+            )
+            for primary, values in changes
+            if values
+        ]
+        if not operations:
+            return 0, 0
+
+        collection = FormRecord._get_collection()
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+        except BulkWriteError:
+            # Concurrent upserts of the same new record can conflict on the unique
+            # index, after which the record exists and the changes can be applied
+            result = collection.bulk_write(operations, ordered=False)
+
+        if revise:
+            self.bump_revision()
+
+        return result.upserted_count, result.matched_count
+
+    def update_record(self, primary, field, value):
+        self.update_records([(primary, {field: value})])
+
+    def clear_data(self):
+        FormRecord.objects(form=self.id).delete()
+        if self.legacy_data:
+            Form.objects(id=self.id).update_one(unset__legacy_data=True)
+            self.legacy_data = []
+
+    def bump_revision(self):
+        from datalab.resolver import get_resolver
+
+        Form.objects(id=self.id).update_one(inc__revision=1)
+        # Ensure that DataLabs built later in this request use the updated form
+        get_resolver().forget(self.id)
 
     # Flat representation of which users should see this form when they load the dashboard
     def refresh_access(self):
-        users = set(
-            record.get(self.permission, "").lower() for record in self.datalab.relations
-        )
-        for invalid_value in [None, ""]:
-            if invalid_value in users:
-                users.remove(invalid_value)
-
-        self.permitted_users = list(users)
+        from datalab.access import build_access_index
+
+        index = build_access_index(self.datalab, self.permission, self.groupBy)
+
+        self.permitted_users = list(index)
         self.save()
+
+
+class FormRecord(Document):
+    """ The responses of a single record of a form, keyed by the value of the
+        form's primary key """
+
+    # Cascade delete if the form is deleted
+    form = ReferenceField(Form, required=True, reverse_delete_rule=2)
+    primary = DynamicField(required=True)
+    values = DictField()
+
+    meta = {"indexes": [{"fields": ("form", "primary"), "unique": True}]}
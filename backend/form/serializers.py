@@ -14,7 +14,7 @@ class FormSerializer(DocumentSerializer):
 
     class Meta:
         model = Form
-        fields = "__all__"
+        exclude = ["legacy_data"]
 
 
 class RestrictedFormSerializer(DocumentSerializer):
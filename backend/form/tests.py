@@ -0,0 +1,27 @@
+from unittest import TestCase
+
+from .utils import encode_field, decode_field, decode_values, record_update
+
+
+class FieldKeyTests(TestCase):
+    def test_dotted_field_is_not_a_path(self):
+        update = record_update({"Q1.a": "yes", "Q2": 3})
+
+        self.assertEqual(len(update), 2)
+        for key in update:
+            prefix, field = key.split(".", 1)
+            self.assertEqual(prefix, "values")
+            self.assertNotIn(".", field)
+
+    def test_dotted_field_is_read_back_under_its_name(self):
+        update = record_update({"Q1.a": "yes"})
+        stored = {key.split(".", 1)[1]: value for key, value in update.items()}
+
+        self.assertEqual(decode_values(stored), {"Q1.a": "yes"})
+
+    def test_reserved_and_escaped_names_round_trip(self):
+        for field in ["$where", "50%", "%2E", "a.$b", "plain", ""]:
+            key = encode_field(field)
+            self.assertFalse(key.startswith("$"))
+            self.assertNotIn(".", key)
+            self.assertEqual(decode_field(key), field)
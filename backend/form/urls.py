@@ -5,6 +5,7 @@ urlpatterns = [
     path("", ListForms.as_view()),
     path("<id>/", DetailForm.as_view()),
     path("<id>/access/", AccessForm.as_view()),
+    path("<id>/access/batch/", AccessFormBatch.as_view()),
     path("<id>/export_structure/", ExportStructure),
     path("<id>/import_data/", ImportData),
 ]
@@ -0,0 +1,34 @@
+from urllib.parse import unquote
+
+
+def encode_field(field):
+    """ Escapes a field name for use as a key of FormRecord.values. Field names
+        are free text, but Mongo treats a dot in a key as a path and reserves
+        keys starting with $. Percent signs are escaped as well, so that the
+        escaping can be reversed exactly """
+    key = field.replace("%", "%25").replace(".", "%2E")
+    if key.startswith("$"):
+        key = "%24" + key[1:]
+
+    return key
+
+
+def decode_field(key):
+    """ Reverses encode_field """
+    return unquote(key)
+
+
+def encode_values(values):
+    """ Escapes the field names of a dict of responses """
+    return {encode_field(field): value for field, value in values.items()}
+
+
+def decode_values(values):
+    """ Restores the field names of a dict of responses read from a FormRecord """
+    return {decode_field(key): value for key, value in values.items()}
+
+
+def record_update(values):
+    """ The $set document which changes the given fields of a FormRecord, leaving
+        its other fields untouched """
+    return {f"values.{key}": value for key, value in encode_values(values).items()}
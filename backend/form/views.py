@@ -13,8 +13,7 @@ import csv
 from .serializers import FormSerializer, RestrictedFormSerializer
 from .models import Form
 
-from accounts.models import lti
-from datalab.utils import get_relations
+from datalab.access import permission_values, find_records
 from datalab.models import Datalab, Column
 from datalab.serializers import DatalabSerializer
 
@@ -22,6 +21,12 @@ import logging
 
 logger = logging.getLogger("ontask")
 
+# Maximum number of cells that can be edited by a single batch request
+FORM_BATCH_LIMIT = 5000
+
+# Number of rows of an imported CSV file which are read and written at a time
+IMPORT_CHUNK_SIZE = 1000
+
 
 class ListForms(APIView):
     def post(self, request):
@@ -38,13 +43,8 @@ class ListForms(APIView):
             "form.create", extra={"user": request.user.email, "payload": request.data}
         )
 
-        datalab = form.datalab
-        datalab.relations = get_relations(
-            datalab.steps, datalab_id=datalab.id, permission=datalab.permission
-        )
-        datalab.save()
-
-        form.refresh_access()
+        # The relations table must include the fields used by the form
+        form.datalab.request_relations_refresh()
 
         return Response(serializer.data, status=HTTP_201_CREATED)
 
@@ -70,9 +70,7 @@ class DetailForm(APIView):
         if "datalab" in request.data:
             del request.data["datalab"]
 
-        # If the primary key has changed, then reset the form data
-        if form.primary != request.data["primary"]:
-            form.data = []
+        primary_changed = form.primary != request.data["primary"]
 
         # Check if the form is being used in the DataLab
         datalab = form.datalab
@@ -111,20 +109,30 @@ class DetailForm(APIView):
         serializer.is_valid()
         serializer.save()
 
+        # If the primary key has changed, then reset the form data
+        if primary_changed:
+            form.clear_data()
+        form.bump_revision()
+
         logger.info(
             "form.edit",
             extra={"id": id, "user": request.user.email, "payload": request.data},
         )
 
-        datalab.relations = get_relations(
-            datalab.steps, datalab_id=datalab.id, permission=datalab.permission
-        )
         datalab.save()
+        datalab.request_relations_refresh()
 
-        form.refresh_access()
-
+        # The data is not built here, as the relations table is only rebuilt in
+        # the background. The client merges the columns into its DataLab, and
+        # fetches the data once relationsStatus is complete
         serializer = FormSerializer(
-            form, context={"updated_datalab": DatalabSerializer(datalab).data}
+            form,
+            context={
+                "updated_datalab": DatalabSerializer(
+                    datalab,
+                    context={"fields": ["id", "order", "columns", "relationsStatus"]},
+                ).data
+            },
         )
 
         return Response(serializer.data, status=HTTP_200_OK)
@@ -144,100 +152,89 @@ class DetailForm(APIView):
 
 
 class AccessForm(APIView):
-    def get_data(self, id):
+    def get_form(self, id):
         try:
-            form = Form.objects.get(id=id)
+            return Form.objects.get(id=id)
         except:
             raise NotFound()
 
-        accessible_records = pd.DataFrame(data=form.datalab.data).set_index(
-            form.primary
+    def get_access(self, form):
+        """ Identifies the records of the form that the user has permission
+            against and may edit, from the relations table and access index of
+            the DataLab, without building it. The records of the user are None if
+            the user has full permission """
+        relations = form.datalab.relations
+        all_records = [record.get(form.primary) for record in relations]
+
+        if form.container.has_full_permission(self.request.user):
+            return None, all_records, None
+
+        access = find_records(
+            form.datalab,
+            form.permission,
+            permission_values(form, self.request.user),
+            form.groupBy,
         )
 
-        has_full_permission = form.container.has_full_permission(self.request.user)
-        user_values = []
+        if not access.rows:
+            # User does not have access to any records, so return a 403
+            raise PermissionDenied()
 
-        if has_full_permission:
-            editable_records = accessible_records.index.values
-            default_group = (
-                accessible_records[form.groupBy].iloc[0] if form.groupBy else None
-            )
+        user_records = [relations[row].get(form.primary) for row in access.rows]
+        editable_records = all_records if form.restriction == "open" else user_records
+
+        if (form.activeFrom is not None and form.activeFrom > dt.utcnow()) or (
+            form.activeTo is not None and form.activeTo < dt.utcnow()
+        ):
+            editable_records = []
+
+        return user_records, editable_records, access
+
+    def get_data(self, form, user_records, access):
+        # Only the fields used by the form are taken from the built DataLab
+        columns = [form.primary, form.permission, form.groupBy, *form.visibleFields]
+        datalab_data = form.datalab.load_data(
+            list(dict.fromkeys(column for column in columns if column))
+        ).set_index(form.primary)
+
+        if user_records is not None:
+            user_data = datalab_data[datalab_data.index.isin(user_records)]
         else:
-            if form.emailAccess:
-                user_values.append(self.request.user.email.lower())
-            if form.ltiAccess:
-                try:
-                    lti_object = lti.objects.get(user=self.request.user.id)
-                    user_values.extend(
-                        [value.lower() for value in lti_object.payload.values()]
-                    )
-                except:
-                    pass
-
-            if form.primary == form.permission:
-                editable_records = accessible_records[
-                    accessible_records.index.str.lower().isin(user_values)
-                ]
-            else:
-                editable_records = accessible_records[
-                    accessible_records[form.permission].str.lower().isin(user_values)
-                ]
-
-            if not len(editable_records):
-                # User does not have access to any records, so return a 403
-                raise PermissionDenied()
+            user_data = datalab_data
 
-            default_group = (
-                editable_records[form.groupBy].iloc[0] if form.groupBy else None
-            )
+        if not form.groupBy:
+            default_group = None
+        elif access is not None and access.grouped:
+            default_group = access.default_group
+        else:
+            default_group = user_data[form.groupBy].iloc[0] if len(user_data) else None
 
-            if form.restriction == "open":
-                editable_records = accessible_records.index.values
-            else:
-                editable_records = editable_records.index.values
+        if form.restriction == "private":
+            # Limit the records to only those which the user has permission against
+            datalab_data = user_data
 
-        datalab_data = (
-            pd.DataFrame(data=form.datalab.data)
-            .set_index(form.primary)
-            .filter(items=[form.primary, *form.visibleFields])
-        )
+        datalab_data = datalab_data.filter(items=form.visibleFields)
 
-        form_data = pd.DataFrame(data=form.data)
         # Only include fields that are in the form design
         # (Some fields may have data, but were removed)
-        form_fields = [form.primary]
-        for field in form.fields:
-            if field.type == "checkbox-group":
-                form_fields.extend(field.columns)
-            else:
-                form_fields.append(field.name)
-
-        form_data = form_data.reindex(columns=form_fields)
+        form_data = pd.DataFrame(data=form.data).reindex(
+            columns=[form.primary, *form.field_columns()]
+        )
 
         if form.primary in form_data:
             form_data.set_index(form.primary, inplace=True)
 
         data = datalab_data.join(form_data).reset_index()
 
-        if form.restriction == "private":
-            # Limit the records to only those which the user has permission against
-            data = data[data[form.primary].isin(editable_records)]
-
         # Replace NaN values with None
-        data.replace({pd.np.nan: None}, inplace=True)
-
-        data = data.to_dict("records")
+        data = data.astype(object).where(pd.notnull(data), None)
 
-        if not has_full_permission and (
-            (form.activeFrom is not None and form.activeFrom > dt.utcnow())
-            or (form.activeTo is not None and form.activeTo < dt.utcnow())
-        ):
-            editable_records = []
-
-        return [form, data, editable_records, default_group]
+        return data.to_dict("records"), default_group
 
     def get(self, request, id):
-        [form, data, editable_records, default_group] = self.get_data(id)
+        form = self.get_form(id)
+        user_records, editable_records, access = self.get_access(form)
+        data, default_group = self.get_data(form, user_records, access)
 
         serializer = RestrictedFormSerializer(
             form,
@@ -253,37 +250,18 @@ class AccessForm(APIView):
         return Response(serializer.data)
 
     def patch(self, request, id):
-        [form, data, editable_records, default_group] = self.get_data(id)
+        form = self.get_form(id)
+        _, editable_records, _ = self.get_access(form)
 
         primary = request.data.get("primary")
         if primary not in editable_records:
             raise PermissionDenied()
 
         field = request.data.get("field")
-        value = request.data.get("value")
-
-        data = pd.DataFrame(data=form.data)
-        if form.primary in data.columns:
-            data.set_index(form.primary, inplace=True)
-            data = data.T.to_dict()
-            if primary in data:
-                data[primary][field] = value
-            else:
-                data[primary] = {field: value}
-            data = (
-                pd.DataFrame.from_dict(data, orient="index")
-                .rename_axis(form.primary)
-                .reset_index()
-            )
-        else:
-            data = pd.DataFrame(data=[{form.primary: primary, field: value}])
+        if field not in form.field_columns():
+            raise ValidationError(f"{field} is not a field of this form")
 
-        # Replace NaN values with None
-        data.replace({pd.np.nan: None}, inplace=True)
-
-        data = data.to_dict("records")
-        form.data = data
-        form.save()
+        form.update_record(primary, field, request.data.get("value"))
 
         logger.info(
             "form.input",
@@ -293,6 +271,57 @@ class AccessForm(APIView):
         return Response(status=HTTP_200_OK)
 
 
+class AccessFormBatch(AccessForm):
+    http_method_names = ["post", "options"]
+
+    def post(self, request, id):
+        """ Applies many cell edits of the form in one request. Every edit is
+            checked before any is applied, and all of them are written in a
+            single bulk write """
+        form = self.get_form(id)
+        _, editable_records, _ = self.get_access(form)
+
+        changes = request.data.get("changes")
+        if not isinstance(changes, list) or not changes:
+            raise ValidationError("A list of changes must be provided")
+        if len(changes) > FORM_BATCH_LIMIT:
+            raise ValidationError(
+                f"No more than {FORM_BATCH_LIMIT} changes can be made at once"
+            )
+
+        editable_records = set(editable_records)
+        field_columns = set(form.field_columns())
+
+        # Group the changes by record, with later changes to a cell taking effect
+        records = {}
+        for change in changes:
+            if not isinstance(change, dict):
+                raise ValidationError("Invalid change")
+
+            primary = change.get("primary")
+            field = change.get("field")
+
+            if isinstance(primary, (dict, list)):
+                raise ValidationError("Invalid primary key")
+            if primary not in editable_records:
+                raise PermissionDenied()
+            if field not in field_columns:
+                raise ValidationError(f"{field} is not a field of this form")
+
+            records.setdefault(primary, {})[field] = change.get("value")
+
+        form.update_records(records.items())
+
+        logger.info(
+            "form.batch_input",
+            extra={"id": id, "user": request.user.email, "payload": request.data},
+        )
+
+        return Response(
+            {"records": len(records), "changes": len(changes)}, status=HTTP_200_OK
+        )
+
+
 @api_view(["POST"])
 @permission_classes([IsAdminUser])
 def ExportStructure(request, id):
@@ -307,12 +336,7 @@ def ExportStructure(request, id):
 
     # Identify the form field names, include the form primary key as the
     # first field so that the join can be performed on the later import
-    fields = [form.primary]
-    for field in form.fields:
-        if field.type == "checkbox-group":
-            fields.extend(field.columns)
-        else:
-            fields.append(field.name)
+    fields = [form.primary, *form.field_columns()]
 
     pd.DataFrame(data=form.data).reindex(columns=fields).to_csv(
         path_or_buf=response, index=False
@@ -326,40 +350,101 @@ def ExportStructure(request, id):
 @api_view(["POST"])
 @permission_classes([IsAdminUser])
 def ImportData(request, id):
+    """ Imports form data from a CSV file, such as one produced by
+        ExportStructure. The file is read and written in chunks, and each row is
+        upserted into the record with the same primary key """
     try:
         form = Form.objects.get(id=id)
     except:
         raise NotFound()
 
-    form_data = pd.DataFrame(form.data).set_index(form.primary).T.to_dict()
+    # The primary keys of the DataLab's records, by their text in a CSV file
+    records = {
+        str(record.get(form.primary)): record.get(form.primary)
+        for record in form.datalab.relations
+        if record.get(form.primary) is not None
+    }
 
-    imported_data = (
-        pd.DataFrame.from_csv(request.data["file"])
-        .replace({pd.np.nan: None})
-        .T.to_dict()
-    )
-    for primary, values in imported_data.items():
-        form_data[primary] = values
+    field_types = {}
+    for field in form.fields:
+        if field.type == "checkbox-group":
+            field_types.update({column: "checkbox" for column in field.columns})
+        else:
+            field_types[field.name] = field.type
 
-    form_data = (
-        pd.DataFrame.from_dict(form_data, orient="index")
-        .rename_axis(form.primary)
-        .reset_index()
-    )
+    file = request.data["file"]
+    try:
+        columns = list(pd.read_csv(file, nrows=0, skipinitialspace=True))
+        file.seek(0)
+        # Values are read as text, and only converted for number and checkbox
+        # fields, so that text such as identifiers is imported unchanged
+        chunks = pd.read_csv(
+            file, dtype=str, chunksize=IMPORT_CHUNK_SIZE, skipinitialspace=True
+        )
+    except Exception:
+        raise ValidationError("The file could not be read as a CSV file")
+
+    if form.primary not in columns:
+        raise ValidationError(f"The file must include the primary key {form.primary}")
+
+    unknown_columns = [
+        column
+        for column in columns
+        if column != form.primary and column not in field_types
+    ]
+    if unknown_columns:
+        raise ValidationError(
+            "The following columns are not fields of this form: "
+            f"{', '.join(unknown_columns)}"
+        )
+
+    counts = {"inserted": 0, "updated": 0, "rejected": 0}
+    for chunk in chunks:
+        # Rows are rejected if they are not a record of the DataLab
+        primaries = [
+            None if pd.isnull(value) else records.get(value.strip())
+            for value in chunk.pop(form.primary)
+        ]
+
+        for column in chunk:
+            if field_types[column] == "number":
+                chunk[column] = pd.to_numeric(chunk[column], errors="coerce")
+            elif field_types[column] == "checkbox":
+                chunk[column] = chunk[column].map(parse_checkbox)
+
+        # Replace NaN values with None
+        chunk = chunk.astype(object).where(pd.notnull(chunk), None)
 
-    # Replace NaN values with None
-    form_data.replace({pd.np.nan: None}, inplace=True)
+        changes = [
+            (primary, values)
+            for primary, values in zip(primaries, chunk.to_dict("records"))
+            if primary is not None
+        ]
+        counts["rejected"] += len(primaries) - len(changes)
 
-    form.data = form_data.to_dict("records")
-    form.save()
+        inserted, updated = form.update_records(changes, revise=False)
+        counts["inserted"] += inserted
+        counts["updated"] += updated
+
+    form.bump_revision()
 
     logger.info(
         "form.import",
-        extra={
-            "id": id,
-            "user": request.user.email,
-            "payload": imported_data
-        },
+        extra={"id": id, "user": request.user.email, **counts},
     )
 
-    return Response(status=HTTP_200_OK)
+    return Response(counts, status=HTTP_200_OK)
+
+
+def parse_checkbox(value):
+    """ Reads the value of a checkbox from its text in a CSV file """
+    if pd.isnull(value):
+        return None
+
+    value = value.strip().lower()
+    if value in ["true", "1", "1.0", "yes", "y"]:
+        return True
+    if value in ["false", "0", "0.0", "no", "n"]:
+        return False
+
+    return None
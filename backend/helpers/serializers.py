@@ -0,0 +1,35 @@
+class ExpandableFieldsMixin:
+    """ Serializer mixin for sparse fieldsets. The fields listed in
+        expandable_fields are expensive to compute, and are only included when
+        requested with ?expand=field1,field2 (or ?expand=all). The fields of the
+        representation can also be restricted with ?fields=field1,field2.
+
+        Views which build the serializer without a request can instead pass
+        "expand" and "fields" lists in the serializer context """
+
+    expandable_fields = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        fields = self.requested("fields")
+        expand = self.requested("expand") or []
+        if "all" in expand:
+            expand = self.expandable_fields
+
+        for field in list(self.fields):
+            if fields and field not in fields:
+                self.fields.pop(field)
+            elif field in self.expandable_fields and field not in expand:
+                self.fields.pop(field)
+
+    def requested(self, parameter):
+        request = self.context.get("request")
+        if request is not None and parameter in request.query_params:
+            return [
+                value.strip()
+                for value in request.query_params[parameter].split(",")
+                if value.strip()
+            ]
+
+        return self.context.get(parameter)
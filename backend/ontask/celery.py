@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import task_prerun, task_postrun
 
 # Set the default Django settings module for celery
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ontask.settings')
@@ -12,3 +13,18 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
+
+
+# Share a single resolver of DataLab modules within each task
+@task_prerun.connect
+def open_resolver_scope(**kwargs):
+    from datalab.resolver import open_scope
+
+    open_scope()
+
+
+@task_postrun.connect
+def close_resolver_scope(**kwargs):
+    from datalab.resolver import close_scope
+
+    close_scope()
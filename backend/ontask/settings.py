@@ -24,9 +24,31 @@ DATALAB_DUMP_BUCKET = None
 LOG_GROUP = None
 EMAIL_BATCH_SIZE = None
 EMAIL_BATCH_PAUSE = None
+# Maximum number of emails sent per second by all workers (unlimited if None)
+EMAIL_RATE_LIMIT = None
+# Number of SMTP connections used concurrently by an email job
+EMAIL_CONCURRENCY = 4
+# Seconds without progress after which an email job is considered lost, and can be
+# resumed
+EMAIL_JOB_LEASE = 600
+# Number of built DataLab tables to keep in memory per process
+DATALAB_CACHE_SIZE = 32
+# Seconds a DataLab build may take before other processes stop waiting for it
+DATALAB_BUILD_TIMEOUT = 120
+# Seconds after a form change before the relations of its DataLab are rebuilt, so
+# that rapid changes result in a single rebuild
+RELATIONS_REFRESH_DELAY = 5
+# Backend used to store the tables of datasources (see datasource/storage.py)
+DATASOURCE_STORAGE = "column_blocks"
+# Seconds between writes of buffered read receipts (written immediately if None)
+READ_RECEIPT_FLUSH_INTERVAL = 2
 
 from ontask.env import *
 
+# Rate limits were previously expressed as a pause between batches of emails
+if EMAIL_RATE_LIMIT is None and EMAIL_BATCH_SIZE and EMAIL_BATCH_PAUSE:
+    EMAIL_RATE_LIMIT = EMAIL_BATCH_SIZE / EMAIL_BATCH_PAUSE
+
 if os.environ.get("ONTASK_DEVELOPMENT"):
     FRONTEND_DOMAIN = (
         "https://localhost:3000"
@@ -48,6 +70,14 @@ DATABASES = {"default": NOSQL_DATABASE}
 # For application data via mongoengine
 mongoengine.connect(NOSQL_DATABASE["NAME"], host=NOSQL_DATABASE["HOST"])
 
+# Task results are stored in MongoDB, as the batches of an email job are
+# gathered by a chord, which requires a result backend
+CELERY_RESULT_BACKEND = f"mongodb://{NOSQL_DATABASE['HOST']}/"
+CELERY_MONGODB_BACKEND_SETTINGS = {
+    "database": NOSQL_DATABASE["NAME"],
+    "taskmeta_collection": "celery_taskmeta",
+}
+
 LTI_URL = LTI_CONFIG.get("url")
 if LTI_URL:
     X_FRAME_OPTIONS = f"ALLOW-FROM {LTI_URL}"
@@ -83,6 +113,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "datalab.resolver.ModuleResolverMiddleware",
 ]
 
 CORS_ORIGIN_WHITELIST = FRONTEND_DOMAIN  # Domain specified in the config file
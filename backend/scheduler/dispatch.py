@@ -0,0 +1,176 @@
+""" Streaming dispatch of emails through a bounded pool of reusable SMTP
+    connections, with sending rate limited to a number of messages per second,
+    either within a process or across every process sharing a limiter """
+
+from django.core.mail import get_connection
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque
+from queue import Queue
+from time import monotonic, sleep, time
+from pymongo import ReturnDocument
+import smtplib
+import threading
+
+import logging
+
+logger = logging.getLogger("emails")
+
+# Errors which are specific to a single message, after which the connection
+# remains usable. Note that all SMTP exceptions are subclasses of OSError
+MESSAGE_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError,
+)
+
+
+def is_connection_error(error):
+    return isinstance(error, OSError) and not isinstance(error, MESSAGE_ERRORS)
+
+
+class RateLimiter:
+    """ Spaces out messages sent from any number of threads so that no more than
+        the given number of messages are sent per second. A rate of None does
+        not limit sending """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            sleep(slot - now)
+
+
+class SharedRateLimiter:
+    """ Spaces out messages sent from any number of threads, tasks and workers
+        so that no more than the given number of messages are sent per second in
+        total. The next free sending slot is stored in a MongoDB collection,
+        and each message atomically reserves a slot before it is sent """
+
+    def __init__(self, collection, key, rate=None):
+        self.collection = collection
+        self.key = key
+        self.interval = 1 / rate if rate else 0
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        # If no message has been sent for a while, the next slot is now rather
+        # than in the past, so that idle time cannot be saved up for a burst
+        now = time()
+        self.collection.update_one(
+            {"_id": self.key, "next_slot": {"$lt": now}},
+            {"$set": {"next_slot": now}},
+        )
+
+        reserved = self.collection.find_one_and_update(
+            {"_id": self.key},
+            {"$inc": {"next_slot": self.interval}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+        slot = reserved["next_slot"] if reserved else now
+
+        if slot > time():
+            sleep(slot - time())
+
+
+class ConnectionPool:
+    """ A fixed number of email backend connections, each of which is opened
+        when first used and then reused for every following message """
+
+    def __init__(self, size, **connection_kwargs):
+        self.connection_kwargs = connection_kwargs
+        self.connections = Queue()
+        for i in range(size):
+            self.connections.put(None)
+
+    @contextmanager
+    def connection(self):
+        connection = self.connections.get()
+        try:
+            if connection is None:
+                connection = get_connection(**self.connection_kwargs)
+                connection.open()
+
+            yield connection
+
+        except Exception as error:
+            # If the connection failed (e.g. the server closed it), then it may
+            # have been left in a broken state, so discard it and open a new one
+            # for the next message. Errors such as a refused recipient are only
+            # reported as a failure of that message
+            if connection is not None and is_connection_error(error):
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                connection = None
+            raise
+
+        finally:
+            self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            connection = self.connections.get()
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+
+def dispatch_emails(
+    emails, send, concurrency=1, rate=None, limiter=None, **connection_kwargs
+):
+    """ Sends a stream of emails concurrently, yielding (email, sent) for each
+        email in the order they were provided. Sending is limited to the given
+        rate, unless a limiter which is shared with other senders is given.
+
+        The emails are consumed lazily, and only a small number of emails are
+        rendered ahead of being sent, so that the whole stream is never held in
+        memory. The send function is called with each email and a connection
+        from the pool, and an email is considered sent if it does not raise """
+
+    concurrency = max(int(concurrency or 1), 1)
+    pool = ConnectionPool(concurrency, **connection_kwargs)
+    limiter = limiter or RateLimiter(rate)
+
+    def deliver(email):
+        limiter.wait()
+        try:
+            with pool.connection() as connection:
+                send(email, connection)
+            return email, True
+        except Exception:
+            logger.exception("email.dispatch_error")
+            return email, False
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            for email in emails:
+                pending.append(executor.submit(deliver, email))
+
+                # Bound the number of rendered emails waiting to be sent
+                if len(pending) >= concurrency * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+    finally:
+        pool.close()
@@ -0,0 +1,121 @@
+from django.core.management.base import BaseCommand
+
+import socketserver
+import threading
+from time import monotonic, sleep
+
+from scheduler.dispatch import dispatch_emails
+from scheduler.utils import send_email
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """ Accepts and discards every message, optionally delaying each response
+        to the end of a message in order to simulate a remote SMTP server """
+
+    def reply(self, response):
+        self.wfile.write(response + b"\r\n")
+
+    def handle(self):
+        self.reply(b"220 localhost OnTask SMTP sink")
+
+        receiving_data = False
+        for line in self.rfile:
+            if receiving_data:
+                if line.rstrip(b"\r\n") == b".":
+                    receiving_data = False
+                    if self.server.latency:
+                        sleep(self.server.latency)
+                    with self.server.lock:
+                        self.server.received += 1
+                    self.reply(b"250 OK")
+                continue
+
+            command = line[:4].upper()
+            if command == b"DATA":
+                receiving_data = True
+                self.reply(b"354 End data with <CR><LF>.<CR><LF>")
+            elif command == b"QUIT":
+                self.reply(b"221 Bye")
+                break
+            else:
+                self.reply(b"250 OK")
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0):
+        super().__init__(("localhost", 0), SMTPSinkHandler)
+        self.latency = latency
+        self.received = 0
+        self.lock = threading.Lock()
+
+
+class Command(BaseCommand):
+    help = "Measures the throughput of the email dispatch against a local SMTP sink"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000)
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument(
+            "--rate", type=float, default=None, help="Maximum messages per second"
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.05,
+            help="Seconds taken by the sink to accept each message",
+        )
+        parser.add_argument(
+            "--size", type=int, default=5000, help="Size of each message in bytes"
+        )
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(latency=options["latency"])
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+        host, port = sink.server_address
+
+        content = "<p>" + "x" * options["size"] + "</p>"
+        emails = (
+            {"recipient": f"student{i}@localhost", "content": content}
+            for i in range(options["messages"])
+        )
+
+        def deliver(email, connection):
+            send_email(
+                email["recipient"],
+                "OnTask dispatch benchmark",
+                email["content"],
+                from_email="ontask@localhost",
+                force_send=True,
+                connection=connection,
+            )
+
+        started = monotonic()
+        sent = 0
+        for email, email_sent in dispatch_emails(
+            emails,
+            deliver,
+            concurrency=options["concurrency"],
+            rate=options["rate"],
+            backend="django.core.mail.backends.smtp.EmailBackend",
+            host=host,
+            port=port,
+            username="",
+            password="",
+            use_tls=False,
+            use_ssl=False,
+        ):
+            sent += email_sent
+        elapsed = monotonic() - started
+
+        sink.shutdown()
+        sink.server_close()
+
+        self.stdout.write(
+            f"Sent {sent}/{options['messages']} messages "
+            f"({sink.received} received by the sink) in {elapsed:.2f}s "
+            f"with {options['concurrency']} connections: "
+            f"{sent / elapsed:.1f} messages per second"
+        )
@@ -1,12 +1,11 @@
-from django.core.mail import get_connection
-from celery import shared_task
+from celery import shared_task, chord
 from celery.execute import send_task
 from django_celery_beat.models import PeriodicTask
 
 from bson.objectid import ObjectId
+from mongoengine.connection import get_db
 import jwt
 import uuid
-from time import sleep
 from datetime import datetime as dt
 import boto3
 import pandas as pd
@@ -18,13 +17,15 @@ from administration.models import Dump
 from datalab.models import Datalab
 
 from .utils import create_crontab, send_email, should_run
+from .dispatch import dispatch_emails, SharedRateLimiter
 
 from ontask.settings import (
     SECRET_KEY,
     BACKEND_DOMAIN,
     FRONTEND_DOMAIN,
     EMAIL_BATCH_SIZE,
-    EMAIL_BATCH_PAUSE,
+    EMAIL_CONCURRENCY,
+    EMAIL_RATE_LIMIT,
     AWS_PROFILE,
     DATALAB_DUMP_BUCKET,
 )
@@ -33,6 +34,15 @@ import logging
 
 logger = logging.getLogger("emails")
 
+# Number of records sent by each batch of an email job, unless configured
+DEFAULT_EMAIL_BATCH_SIZE = 250
+
+# Number of emails sent between each checkpoint of an email job
+EMAIL_CHECKPOINT_SIZE = 25
+
+# Collection holding the next free slot for sending an email
+EMAIL_RATE_LIMIT_COLLECTION = "email_rate_limit"
+
 
 @shared_task
 @should_run
@@ -46,6 +56,53 @@ def refresh_datasource_data(datasource_id=None, **kwargs):
     return "Data imported successfully"
 
 
+@shared_task
+def refresh_datalab_relations(datalab_id, request):
+    """ Rebuilds the relations table and access of a DataLab, unless a later
+        rebuild has been requested since this one was scheduled """
+    datalab = Datalab.objects(id=ObjectId(datalab_id)).first()
+    if not datalab or datalab.relationsRequest != request:
+        return "Relations refresh superseded"
+
+    try:
+        datalab.refresh_relations()
+    except Exception:
+        Datalab.objects(id=datalab.id, relationsRequest=request).update_one(
+            set__relationsStatus="failed"
+        )
+        raise
+
+    # A request made during the rebuild leaves the status as pending, as its own
+    # rebuild will follow
+    Datalab.objects(id=datalab.id, relationsRequest=request).update_one(
+        set__relationsStatus="complete"
+    )
+
+    from datalab.dependencies import propagate_change
+    from form.models import Form
+
+    # Rebuild any DataLabs which are built from this one, and their forms, but
+    # not the forms of this DataLab which were refreshed above
+    propagate_change(
+        "datalab",
+        datalab.id,
+        skip=[("form", str(form.id)) for form in Form.objects(datalab=datalab.id)],
+    )
+
+    return "Relations refreshed successfully"
+
+
+@shared_task
+def rebuild_dependency(kind, node_id):
+    """ Rebuilds a single node of the dependency graph, as part of the
+        propagation of a change to one of its dependencies """
+    from datalab.dependencies import rebuild_node
+
+    rebuild_node(kind, node_id)
+
+    return f"Rebuilt {kind} {node_id}"
+
+
 @shared_task
 def dump_datalab_data(**kwargs):
     from datalab.serializers import OrderItemSerializer
@@ -89,131 +146,278 @@ def dump_datalab_data(**kwargs):
     return "DataLab data dumped successfully"
 
 
-@shared_task
-@should_run
-def workflow_send_email(action_id=None, job_type="Scheduled", **kwargs):
-    """ Send email based on the schedule in workflow model """
-    logger.info("email.initiate", extra={"action": action_id, "job_type": job_type})
+def tracked_content(action, job_id, email_id, content):
+    """ Appends the tracking pixel and, if enabled, the feedback link to the
+        populated content of an email """
+    tracking_token = jwt.encode(
+        {"action_id": str(action.id), "job_id": str(job_id), "email_id": str(email_id)},
+        SECRET_KEY,
+        algorithm="HS256",
+    ).decode("utf-8")
 
-    from workflow.models import Workflow, EmailJob, Email
+    tracking_link = f"{BACKEND_DOMAIN}/workflow/read_receipt/?email={tracking_token}"
+    content += f"<img src='{tracking_link}'/>"
 
-    action = Workflow.objects.get(id=ObjectId(action_id))
+    if action.emailSettings.include_feedback:
+        feedback_link = f"{FRONTEND_DOMAIN}/feedback/{action.id}/?job={job_id}&email={email_id}"
+        content += (
+            "<p>Did you find this correspondence useful? Please provide your "
+            f"feedback by <a href='{feedback_link}'>clicking here</a>.</p>"
+        )
 
-    populated_content = action.populate_content()
+    return content
+
+
+def send_action_emails(
+    action, evaluation, job_id, recipients=None, delivered=None, checkpoint=None
+):
+    """ Populates and sends the emails of an action, optionally only to the
+        records addressed to the given recipients. The emails sent, failed
+        recipients and number of records without a recipient are passed to the
+        checkpoint function as sending progresses, and sending stops once it
+        returns False.
+
+        An email is sent for each record, even if several records are addressed
+        to the same recipient. Each record is identified by its recipient and
+        the number of records addressed to that recipient before it, and the
+        records whose (recipient, occurrence) is returned by the delivered
+        function are skipped. It is called again at each checkpoint, so that
+        records delivered by any other task in the meantime are skipped as
+        well """
     email_settings = action.emailSettings
 
-    job_id = ObjectId()
-    job = EmailJob(
-        job_id=job_id,
-        subject=email_settings.subject,
-        type=job_type,
-        included_feedback=email_settings.include_feedback and True,
-        emails=[],
-    )
+    progress = {"emails": [], "failures": [], "null_recipients": 0}
+    totals = {"sent": 0, "failed": 0, "skipped": 0, "null_recipients": 0}
+    state = {"delivered": delivered() if delivered else set(), "stopped": False}
+    occurrences = {}
+
+    def flush():
+        if checkpoint and (
+            progress["emails"] or progress["failures"] or progress["null_recipients"]
+        ):
+            proceed = checkpoint(
+                progress["emails"], progress["failures"], progress["null_recipients"]
+            )
+            if proceed is False:
+                state["stopped"] = True
+
+            if delivered:
+                state["delivered"] = delivered()
+
+        totals["null_recipients"] += progress["null_recipients"]
+        progress.update(emails=[], failures=[], null_recipients=0)
+
+    def generate_emails():
+        # Content is populated lazily, as each email is about to be sent
+        for item, content in evaluation.iter_content(recipients=recipients):
+            # Emails already handed to the dispatcher are still sent and
+            # recorded, but no further emails are generated
+            if state["stopped"]:
+                return
+
+            recipient = item.get(email_settings.field)
+            if recipient == "" or recipient is None:
+                progress["null_recipients"] += 1
+                continue
+
+            occurrence = occurrences.get(recipient, 0)
+            occurrences[recipient] = occurrence + 1
+
+            if (recipient, occurrence) in state["delivered"]:
+                totals["skipped"] += 1
+                continue
+
+            email_id = uuid.uuid4().hex
+            yield {
+                "email_id": email_id,
+                "recipient": recipient,
+                "occurrence": occurrence,
+                "content": content,
+                "tracked_content": tracked_content(action, job_id, email_id, content),
+            }
+
+    def deliver(email, connection):
+        send_email(
+            email["recipient"],
+            email_settings.subject,
+            email["tracked_content"],
+            from_name=email_settings.fromName,
+            reply_to=email_settings.replyTo,
+            connection=connection,
+        )
 
-    successes = []
-    failures = []
-    null_recipients = 0
+    connection_kwargs = {}
+    if os.environ.get("ONTASK_DEVELOPMENT"):
+        connection_kwargs["backend"] = "django.core.mail.backends.dummy.EmailBackend"
 
-    messages = action.data["records"]
-    batch_size = EMAIL_BATCH_SIZE if EMAIL_BATCH_SIZE else len(messages)
-    batch_pause = EMAIL_BATCH_PAUSE if EMAIL_BATCH_PAUSE else 0
+    # The rate limit applies to all emails sent by every batch of every job,
+    # regardless of how many workers the batches are spread across
+    limiter = SharedRateLimiter(
+        get_db()[EMAIL_RATE_LIMIT_COLLECTION], "email", EMAIL_RATE_LIMIT
+    )
 
-    email_batches = [
-        messages[i : i + batch_size] for i in range(0, len(messages), batch_size)
-    ]
+    for email, email_sent in dispatch_emails(
+        generate_emails(),
+        deliver,
+        concurrency=EMAIL_CONCURRENCY,
+        limiter=limiter,
+        **connection_kwargs,
+    ):
+        if email_sent:
+            progress["emails"].append(
+                {
+                    "email_id": email["email_id"],
+                    "recipient": email["recipient"],
+                    "occurrence": email["occurrence"],
+                    # Content without the tracking pixel
+                    "content": email["content"],
+                }
+            )
+            totals["sent"] += 1
+        else:
+            progress["failures"].append(email["recipient"])
+            totals["failed"] += 1
 
-    recipient_count = 0
-    for batch_index, batch in enumerate(email_batches):
         logger.info(
-            "email.batch",
+            f"email.{'success' if email_sent else 'fail'}",
             extra={
-                "action": action_id,
-                "current": batch_index + 1,
-                "total": len(email_batches),
+                "action": str(action.id),
+                "recipient": email["recipient"],
+                "from": email_settings.fromName,
+                "reply-to": email_settings.replyTo,
+                "subject": email_settings.subject,
+                "content": email["tracked_content"],
             },
         )
 
-        # Open a connection to the SMTP server, which will be used for every email sent in this batch
-        # It is done per batch to avoid the risk of the connection timing out if the batch_delay is long
-        with get_connection() as connection:
-
-            for index, item in enumerate(batch):
-                recipient = item.get(email_settings.field)
-                if recipient == "" or recipient is None:
-                    null_recipients = +1
-                else:
-                    email_content = populated_content[recipient_count]
-
-                    email_id = uuid.uuid4().hex
-                    tracking_token = jwt.encode(
-                        {
-                            "action_id": str(action.id),
-                            "job_id": str(job_id),
-                            "email_id": str(email_id),
-                        },
-                        SECRET_KEY,
-                        algorithm="HS256",
-                    ).decode("utf-8")
-
-                    tracking_link = f"{BACKEND_DOMAIN}/workflow/read_receipt/?email={tracking_token}"
-                    tracking_pixel = f"<img src='{tracking_link}'/>"
-                    email_content += tracking_pixel
-
-                    if email_settings.include_feedback:
-                        feedback_link = f"{FRONTEND_DOMAIN}/feedback/{action.id}/?job={job_id}&email={email_id}"
-                        email_content += (
-                            "<p>Did you find this correspondence useful? Please provide your "
-                            f"feedback by <a href='{feedback_link}'>clicking here</a>.</p>"
-                        )
-
-                    if os.environ.get("ONTASK_DEVELOPMENT"):
-                        email_sent = True
-                    else:
-                        email_sent = send_email(
-                            recipient,
-                            email_settings.subject,
-                            email_content,
-                            from_name=email_settings.fromName,
-                            reply_to=email_settings.replyTo,
-                            connection=connection,
-                        )
-
-                    if email_sent:
-                        job.emails.append(
-                            Email(
-                                email_id=email_id,
-                                recipient=recipient,
-                                # Content without the tracking pixel
-                                content=populated_content[index],
-                            )
-                        )
-
-                        successes.append(recipient)
-                    else:
-                        failures.append(recipient)
-
-                    logger.info(
-                        f"email.{'success' if email_sent else 'fail'}",
-                        extra={
-                            "action": action_id,
-                            "batch": batch_index + 1,
-                            "recipient": recipient,
-                            "from": email_settings.fromName,
-                            "reply-to": email_settings.replyTo,
-                            "subject": email_settings.subject,
-                            "content": email_content,
-                        },
-                    )
-
-                recipient_count += 1
-
-            if batch_index + 1 != len(email_batches) and batch_pause > 0:
-                sleep(batch_pause)
-
-    action.emailJobs.append(job)
-
-    action.save()
+        if len(progress["emails"]) + len(progress["failures"]) >= EMAIL_CHECKPOINT_SIZE:
+            flush()
+
+    flush()
+
+    return totals
+
+
+@shared_task
+@should_run
+def workflow_send_email(
+    action_id=None, job_type="Scheduled", resume_job=None, run=None, **kwargs
+):
+    """ Send email based on the schedule in workflow model. The records of the
+        action are split into batches, which are sent by separate tasks that can
+        run on any number of workers, and then gathered into a single job.
+
+        The job is recorded before any emails are sent and updated as each batch
+        progresses. If resume_job is given, that job is continued instead, and
+        the records it already delivered are skipped. The job must first
+        have been claimed for the given run, so that its previous tasks stop """
+    logger.info(
+        "email.initiate",
+        extra={"action": action_id, "job_type": job_type, "resume_job": resume_job},
+    )
+
+    from workflow.models import Workflow
+
+    action = Workflow.objects.get(id=ObjectId(action_id))
+
+    if resume_job:
+        job_id = resume_job
+    else:
+        job = action.start_email_job(job_type)
+        job_id, run = str(job.job_id), job.run
+
+    # The batches are given the recipients to send to rather than positions in
+    # the records, as the DataLab may change before a batch is run. Records
+    # without a recipient are counted here, as no batch will consider them
+    data = action.evaluate().filtered_data
+    field = action.emailSettings.field
+    values = data[field].tolist() if field in data else [None] * len(data)
+
+    recipients = list(
+        dict.fromkeys(
+            value for value in values if isinstance(value, str) and value != ""
+        )
+    )
+    null_recipients = len(
+        [value for value in values if not isinstance(value, str) or value == ""]
+    )
+    if null_recipients and not action.checkpoint_email_job(
+        job_id, run, [], [], null_recipients
+    ):
+        logger.info("email.superseded", extra={"action": action_id, "job": job_id})
+        return "Email job was resumed by another task."
+
+    batch_size = EMAIL_BATCH_SIZE if EMAIL_BATCH_SIZE else DEFAULT_EMAIL_BATCH_SIZE
+
+    batches = [
+        workflow_send_email_batch.s(
+            action_id, job_id, run, recipients[start : start + batch_size]
+        )
+        for start in range(0, len(recipients), batch_size)
+    ]
+    complete = workflow_send_email_complete.s(action_id, job_id, run)
+
+    if batches:
+        chord(batches)(complete)
+    else:
+        complete.delay([])
+
+    logger.info(
+        "email.dispatch",
+        extra={"action": action_id, "job": job_id, "batches": len(batches)},
+    )
+
+    return f"Email job dispatched in {len(batches)} batches."
+
+
+# The batch is only acknowledged once it has finished, so that it is delivered to
+# another worker if this one is lost. The checkpoints of the job ensure that the
+# recipients which were already sent to are not sent to again.
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def workflow_send_email_batch(action_id, job_id, run, recipients):
+    """ Sends the emails of a single batch of an email job, i.e. the emails of
+        the records addressed to the given recipients. The batch stops at its
+        next checkpoint if the job has since been resumed by another run """
+    from workflow.models import Workflow
+
+    action = Workflow.objects.get(id=ObjectId(action_id))
+
+    logger.info(
+        "email.batch",
+        extra={"action": action_id, "job": job_id, "recipients": len(recipients)},
+    )
+
+    def checkpoint(emails, failures, null_recipients):
+        return action.checkpoint_email_job(
+            job_id, run, emails, failures, null_recipients
+        )
+
+    return send_action_emails(
+        action,
+        action.evaluate(),
+        job_id,
+        recipients=set(recipients),
+        delivered=lambda: action.delivered_records(job_id),
+        checkpoint=checkpoint,
+    )
+
+
+@shared_task
+def workflow_send_email_complete(results, action_id, job_id, run):
+    """ Marks an email job as completed once every batch has finished, and
+        notifies the container owner. Only the run which currently holds the job
+        can complete it, so the owner is notified once """
+    from workflow.models import Workflow
+
+    action = Workflow.objects.get(id=ObjectId(action_id))
+    job = action.complete_email_job(job_id, run)
+    if job is None:
+        logger.info("email.superseded", extra={"action": action_id, "job": job_id})
+        return "Email job was resumed by another task."
+
+    successes = list(action.get_emails(job_id).scalar("recipient"))
+    failures = job.failures
+    null_recipients = job.null_recipients
 
     if not os.environ.get("ONTASK_DEVELOPMENT"):
         if len(failures) == 0 and null_recipients == 0:
@@ -234,6 +438,6 @@ def workflow_send_email(action_id=None, job_type="Scheduled", **kwargs):
                 """,
             )
 
-    logger.info("email.complete", extra={"action": action_id, "job_type": job_type})
+    logger.info("email.complete", extra={"action": action_id, "job": job_id})
 
     return "Email job completed."
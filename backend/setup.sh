@@ -5,3 +5,7 @@ python3 manage.py makemigrations
 python3 manage.py migrate
 
 python3 manage.py loaddata user_groups
+
+python3 manage.py migrate_email_jobs
+python3 manage.py migrate_datasource_data
+python3 manage.py migrate_form_data
@@ -0,0 +1,183 @@
+from functools import wraps
+
+from datalab.resolver import get_resolver
+
+from .utils import condition_mask, assign_rules, compile_content
+
+
+def evaluated(f):
+    """ Property which is computed at most once per evaluation """
+    name = f.__name__
+
+    @property
+    @wraps(f)
+    def wrapper(self):
+        if name not in self._evaluated:
+            self._evaluated[name] = f(self)
+        return self._evaluated[name]
+
+    return wrapper
+
+
+class ActionEvaluation:
+    """ Evaluates an action against its DataLab. The DataLab table, options,
+        column order and rule assignment are each built once and shared by
+        everything that uses this evaluation, e.g. a content preview or an
+        email job """
+
+    def __init__(self, action):
+        self.action = action
+        self.resolver = get_resolver()
+        self._evaluated = {}
+
+    @evaluated
+    def datalab(self):
+        return self.action.datalab
+
+    @evaluated
+    def options(self):
+        modules = []
+        types = {}
+        labels = []
+
+        # Create a "pseudo" module to hold the computed fields
+        computed = {"type": "computed", "fields": []}
+
+        resolver = self.resolver
+        resolver.prefetch(self.datalab.steps)
+
+        # Iterate over the modules of the datalab
+        for step in self.datalab.steps:
+            module = {"type": step.type, "fields": []}
+            module_labels = {}
+
+            if step.type == "datasource":
+                datasource = resolver.module(step.datasource.id)
+
+                if datasource:
+                    module["name"] = datasource.name
+                    for field in step.datasource.fields:
+                        label = step.datasource.labels[field]
+                        module["fields"].append(label)
+                        types[label] = step.datasource.types[field]
+                        module_labels[field] = label
+                    modules.append(module)
+                    labels.append(module_labels)
+
+            if step.type == "form":
+                form = resolver.form(step.form)
+                module["name"] = form.name
+                for field in form.fields:
+                    if field.type == "checkbox-group":
+                        for column in field.columns:
+                            module["fields"].append(column)
+                            types[column] = "checkbox"
+                            module_labels[column] = column
+                    else:
+                        module["fields"].append(field.name)
+                        types[field.name] = field.type
+                        module_labels[field.name] = field.name
+                modules.append(module)
+                labels.append(module_labels)
+
+            if step.type == "computed":
+                for field in step.computed.fields:
+                    computed["fields"].append(field.name)
+                    types[field.name] = field.type
+                    module_labels[field.name] = field.name
+                    labels.append(module_labels)
+
+        modules.append(computed)
+
+        return {"modules": modules, "types": types, "labels": labels}
+
+    @evaluated
+    def order(self):
+        from datalab.serializers import OrderItemSerializer
+
+        return OrderItemSerializer(
+            self.datalab.order,
+            many=True,
+            context={"steps": self.datalab.steps, "resolver": self.resolver},
+        ).data
+
+    @evaluated
+    def column_order(self):
+        column_order = []
+        for item in self.order:
+            if item["details"]["field_type"] == "checkbox-group":
+                column_order.extend(item["details"]["fields"])
+            else:
+                column_order.append(item["details"]["label"])
+
+        return column_order
+
+    @evaluated
+    def unfiltered_data(self):
+        return self.datalab.frame
+
+    @evaluated
+    def filtered_data(self):
+        """ The DataLab table limited to the records that satisfy the filter """
+        data = self.unfiltered_data
+        if not self.action.filter:
+            return data
+
+        mask = condition_mask(
+            self.action.filter.conditions[0],
+            self.action.filter.parameters,
+            data,
+            self.options["types"],
+        )
+        return data[mask]
+
+    @evaluated
+    def records(self):
+        return self.filtered_data.to_dict("records")
+
+    @evaluated
+    def populated_rules(self):
+        """ Boolean mask of the filtered records assigned to each condition id """
+        return assign_rules(
+            self.action.rules, self.filtered_data, self.options["types"]
+        )
+
+    @evaluated
+    def data(self):
+        return {
+            "records": self.records,
+            "order": self.column_order,
+            "unfilteredLength": len(self.unfiltered_data),
+            "filteredLength": len(self.filtered_data),
+        }
+
+    def iter_content(self, content=None, recipients=None):
+        """ Lazily populates the content for each record, yielding each record
+            along with its populated content. If a set of recipients is given,
+            then only the records addressed to them are populated """
+        if not content and not self.action.content:
+            return
+        elif not content:
+            content = self.action.content
+
+        template = compile_content(content, self.order)
+        field = self.action.emailSettings.field if self.action.emailSettings else None
+
+        for item_index, item in enumerate(self.records):
+            if recipients is not None:
+                recipient = item.get(field)
+                if not isinstance(recipient, str) or recipient not in recipients:
+                    continue
+
+            populated_conditions = {
+                condition_id
+                for condition_id, mask in self.populated_rules.items()
+                if mask[item_index]
+            }
+            yield item, template.render(item, populated_conditions)
+
+    def populate_content(self, content=None):
+        return [
+            populated_content
+            for item, populated_content in self.iter_content(content)
+        ]
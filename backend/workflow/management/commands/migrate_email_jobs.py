@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from workflow.models import Workflow, EmailJob, Email
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the email jobs embedded in actions into the email job and email "
+        "collections"
+    )
+
+    def handle(self, *args, **options):
+        actions = Workflow._get_collection()
+        email_jobs = EmailJob._get_collection()
+        emails = Email._get_collection()
+
+        migrated = 0
+        for action in actions.find(
+            {"emailJobs": {"$exists": True}}, {"emailJobs": True}
+        ):
+            for job in action["emailJobs"]:
+                job_emails = job.pop("emails", [])
+                job_id = job.get("job_id")
+
+                # The job is inserted after its emails, so a job which already
+                # exists was moved in full by a previous run
+                query = {"action": action["_id"], "job_id": job_id}
+                if email_jobs.find_one(query):
+                    continue
+
+                emails.delete_many(query)
+                if job_emails:
+                    emails.insert_many(
+                        [
+                            {**email, "action": action["_id"], "job_id": job_id}
+                            for email in job_emails
+                        ]
+                    )
+                email_jobs.insert_one({**job, "action": action["_id"]})
+
+            actions.update_one({"_id": action["_id"]}, {"$unset": {"emailJobs": ""}})
+            migrated += 1
+
+        self.stdout.write(f"Migrated the email jobs of {migrated} actions")
@@ -13,20 +13,24 @@ from mongoengine.fields import (
     ObjectIdField,
     BaseField,
 )
-from datetime import datetime
-from collections import defaultdict
+from mongoengine.queryset.visitor import Q
+from datetime import datetime, timedelta
 from bson.objectid import ObjectId
 import jwt
+import uuid
 
 from container.models import Container
 from datalab.models import Datalab
-from datasource.models import Datasource
-from form.models import Form
 
-from .utils import did_pass_test, parse_content_line
+from .evaluation import ActionEvaluation
 from scheduler.tasks import workflow_send_email
 
-from ontask.settings import SECRET_KEY, BACKEND_DOMAIN, FRONTEND_DOMAIN
+from ontask.settings import (
+    SECRET_KEY,
+    BACKEND_DOMAIN,
+    FRONTEND_DOMAIN,
+    EMAIL_JOB_LEASE,
+)
 
 
 class Formula(EmbeddedDocument):
@@ -89,27 +93,6 @@ class EmailSettings(EmbeddedDocument):
     textbox_question = StringField()
 
 
-class Email(EmbeddedDocument):
-    email_id = StringField()
-    recipient = StringField()
-    content = StringField()
-    list_feedback = StringField()
-    textbox_feedback = StringField()
-    feedback_datetime = DateTimeField()
-    track_count = IntField(default=0)
-    first_tracked = DateTimeField()
-    last_tracked = DateTimeField()
-
-
-class EmailJob(EmbeddedDocument):
-    job_id = ObjectIdField()
-    subject = StringField()
-    emails = EmbeddedDocumentListField(Email)
-    type = StringField(choices=["Manual", "Scheduled"])
-    initiated_at = DateTimeField(default=datetime.utcnow)
-    included_feedback = BooleanField()
-
-
 class Workflow(Document):
     container = ReferenceField(
         Container, required=True, reverse_delete_rule=2
@@ -125,179 +108,29 @@ class Workflow(Document):
     emailSettings = EmbeddedDocumentField(EmailSettings)
     schedule = EmbeddedDocumentField(Schedule, null=True, required=False)
     linkId = StringField(null=True)  # link_id is unique across workflow objects
-    emailJobs = EmbeddedDocumentListField(EmailJob)
+
+    # Actions which have not been migrated yet may still embed their email jobs
+    meta = {"strict": False}
 
     @property
     def datalab_name(self):
         return self.datalab.name
 
+    def evaluate(self):
+        """ Evaluation context which builds the DataLab table, options, column
+            order and rule assignment of this action only once """
+        return ActionEvaluation(self)
+
     @property
     def options(self):
-        modules = []
-        types = {}
-        labels = []
-
-        # Create a "pseudo" module to hold the computed fields
-        computed = {"type": "computed", "fields": []}
-
-        # Iterate over the modules of the datalab
-        for step in self.datalab.steps:
-            module = {"type": step.type, "fields": []}
-            module_labels = {}
-
-            if step.type == "datasource":
-                datasource = None
-                try:
-                    datasource = Datasource.objects.get(id=step.datasource.id)
-                except:
-                    pass
-
-                try:
-                    datasource = Datalab.objects.get(id=step.datasource.id)
-                except:
-                    pass
-
-                if datasource:
-                    module["name"] = datasource.name
-                    for field in step.datasource.fields:
-                        label = step.datasource.labels[field]
-                        module["fields"].append(label)
-                        types[label] = step.datasource.types[field]
-                        module_labels[field] = label
-                    modules.append(module)
-                    labels.append(module_labels)
-
-            if step.type == "form":
-                form = Form.objects.get(id=step.form)
-                module["name"] = form.name
-                for field in form.fields:
-                    if field.type == "checkbox-group":
-                        for column in field.columns:
-                            module["fields"].append(column)
-                            types[column] = "checkbox"
-                            module_labels[column] = column
-                    else:
-                        module["fields"].append(field.name)
-                        types[field.name] = field.type
-                        module_labels[field.name] = field.name
-                modules.append(module)
-                labels.append(module_labels)
-
-            if step.type == "computed":
-                for field in step.computed.fields:
-                    computed["fields"].append(field.name)
-                    types[field.name] = field.type
-                    module_labels[field.name] = field.name
-                    labels.append(module_labels)
-
-        modules.append(computed)
-
-        return {"modules": modules, "types": types, "labels": labels}
+        return self.evaluate().options
 
     @property
     def data(self):
-        options = self.options
-    
-        if self.filter:
-            filtered_data = []
-
-            types = options["types"]
-            parameters = self.filter.parameters
-            condition = self.filter.conditions[0]
-
-            for item in self.datalab.data:
-                if all(
-                    [
-                        did_pass_test(
-                            condition.formulas[parameter_index],
-                            item.get(parameter),
-                            types.get(parameter),
-                        )
-                        for parameter_index, parameter in enumerate(parameters)
-                    ]
-                ):
-                    filtered_data.append(item)
-
-        else:
-            filtered_data = self.datalab.data
-
-        column_order = []
-        from datalab.serializers import OrderItemSerializer
-        order = OrderItemSerializer(
-            self.datalab.order, many=True, context={"steps": self.datalab.steps}
-        ).data
-            
-        for item in order:
-            if item["details"]["field_type"] == "checkbox-group":
-                column_order.extend(item["details"]["fields"])
-            else:
-                column_order.append(item["details"]["label"])
-
-        return {
-            "records": filtered_data,
-            "order": column_order,
-            "unfilteredLength": len(self.datalab.data),
-            "filteredLength": len(filtered_data),
-        }
+        return self.evaluate().data
 
     def populate_content(self, content=None):
-        if not content and not self.content:
-            return []
-        elif not content:
-            content = self.content
-
-        filtered_data = self.data["records"]
-        types = self.options["types"]
-
-        # Assign each record to the rule groups
-        populated_rules = defaultdict(set)
-        for item_index, item in enumerate(filtered_data):
-            for rule in self.rules:
-                parameters = rule.parameters
-                did_match = False
-
-                for condition in rule.conditions:
-                    if all(
-                        [
-                            did_pass_test(
-                                condition.formulas[parameter_index],
-                                item.get(parameter),
-                                types.get(parameter),
-                            )
-                            for parameter_index, parameter in enumerate(parameters)
-                        ]
-                    ):
-                        did_match = True
-                        populated_rules[condition.conditionId].add(item_index)
-                        break
-
-                if not did_match:
-                    populated_rules[rule.catchAll].add(item_index)
-
-        block_map = content["blockMap"]["document"]["nodes"]
-        html = content["html"]
-        result = []
-
-        from datalab.serializers import OrderItemSerializer
-        order = OrderItemSerializer(
-            self.datalab.order, many=True, context={"steps": self.datalab.steps}
-        ).data
-
-        # Populate the content for each record
-        for item_index, item in enumerate(filtered_data):
-            populated_content = ""
-
-            for block_index, block in enumerate(block_map):
-                if block["type"] == "condition":
-                    condition_id = block["data"]["conditionId"]
-                    if item_index in populated_rules.get(ObjectId(condition_id), {}):
-                        populated_content += parse_content_line(html[block_index], item, order)
-                else:
-                    populated_content += parse_content_line(html[block_index], item, order)
-
-            result.append(populated_content)
-
-        return result
+        return self.evaluate().populate_content(content)
 
     def clean_content(self, conditions):
         if not self.content:
@@ -314,5 +147,143 @@ class Workflow(Document):
 
         return self.content
 
-    def send_email(self):
-        workflow_send_email.delay(action_id=str(self.id), job_type="Manual")
+    def send_email(self, resume_job=None, run=None):
+        workflow_send_email.delay(
+            action_id=str(self.id), job_type="Manual", resume_job=resume_job, run=run
+        )
+
+    def get_email_job(self, job_id):
+        try:
+            job_id = ObjectId(job_id)
+        except Exception:
+            return None
+
+        return EmailJob.objects(action=self.id, job_id=job_id).first()
+
+    def get_email_jobs(self):
+        return EmailJob.objects(action=self.id).order_by("initiated_at")
+
+    def get_emails(self, job_id=None):
+        if job_id is None:
+            return Email.objects(action=self.id)
+
+        return Email.objects(action=self.id, job_id=ObjectId(job_id))
+
+    def start_email_job(self, job_type):
+        """ Records a new email job before any of its emails are sent """
+        return EmailJob(
+            action=self,
+            job_id=ObjectId(),
+            subject=self.emailSettings.subject,
+            type=job_type,
+            included_feedback=self.emailSettings.include_feedback and True,
+            status="In progress",
+            run=uuid.uuid4().hex,
+            heartbeat=datetime.utcnow(),
+        ).save()
+
+    def claim_email_job(self, job_id):
+        """ Takes over an incomplete job whose tasks have made no progress within
+            the lease, and returns the new run, or None if the job is still being
+            sent. The failures and recipients without an email address are
+            cleared, as the records they belong to are processed again """
+        run = uuid.uuid4().hex
+        now = datetime.utcnow()
+        expired = Q(heartbeat__lt=now - timedelta(seconds=EMAIL_JOB_LEASE)) | Q(
+            heartbeat=None
+        )
+
+        claimed = EmailJob.objects(
+            expired, action=self.id, job_id=ObjectId(job_id), status="In progress"
+        ).update_one(
+            set__run=run,
+            set__heartbeat=now,
+            set__failures=[],
+            set__null_recipients=0,
+        )
+
+        return run if claimed else None
+
+    def delivered_records(self, job_id):
+        """ The (recipient, occurrence) of each record that an email of the job
+            was sent for """
+        return set(self.get_emails(job_id).scalar("recipient", "occurrence"))
+
+    def checkpoint_email_job(self, job_id, run, emails, failures, null_recipients):
+        """ Records the progress of a batch of an email job and renews its lease.
+            Returns False if the job has since been claimed by another run, in
+            which case the emails are recorded but the job is not updated """
+        if emails:
+            Email.objects.insert(
+                [
+                    Email(action=self, job_id=ObjectId(job_id), **email)
+                    for email in emails
+                ],
+                load_bulk=False,
+            )
+
+        result = EmailJob._get_collection().update_one(
+            {
+                "action": self.id,
+                "job_id": ObjectId(job_id),
+                "run": run,
+                "status": "In progress",
+            },
+            {
+                "$push": {"failures": {"$each": failures}},
+                "$inc": {"null_recipients": null_recipients},
+                "$set": {"heartbeat": datetime.utcnow()},
+            },
+        )
+
+        return result.matched_count > 0
+
+    def complete_email_job(self, job_id, run):
+        """ Marks a job as completed, unless it has since been claimed by another
+            run. Returns the job, or None if it was not completed by this run """
+        completed = EmailJob.objects(
+            action=self.id, job_id=ObjectId(job_id), run=run, status="In progress"
+        ).update_one(set__status="Completed", set__completed_at=datetime.utcnow())
+
+        return self.get_email_job(job_id) if completed else None
+
+
+class EmailJob(Document):
+    action = ReferenceField(
+        Workflow, required=True, reverse_delete_rule=2
+    )  # Cascade delete if action is deleted
+    job_id = ObjectIdField(required=True)
+    subject = StringField()
+    type = StringField(choices=["Manual", "Scheduled"])
+    initiated_at = DateTimeField(default=datetime.utcnow)
+    included_feedback = BooleanField()
+    # Jobs without a status were sent in full before jobs were checkpointed
+    status = StringField(choices=["In progress", "Completed"])
+    completed_at = DateTimeField()
+    failures = ListField(StringField())
+    null_recipients = IntField(default=0)
+    # The run of tasks currently sending the job, and when it last made progress
+    run = StringField()
+    heartbeat = DateTimeField()
+
+    meta = {"indexes": [("action", "job_id")]}
+
+
+class Email(Document):
+    action = ReferenceField(
+        Workflow, required=True, reverse_delete_rule=2
+    )  # Cascade delete if action is deleted
+    job_id = ObjectIdField(required=True)
+    email_id = StringField()
+    recipient = StringField()
+    # Number of records addressed to the recipient before the record of this email
+    occurrence = IntField(default=0)
+    content = StringField()
+    list_feedback = StringField()
+    textbox_feedback = StringField()
+    feedback_datetime = DateTimeField()
+    track_count = IntField(default=0)
+    first_tracked = DateTimeField()
+    last_tracked = DateTimeField()
+
+    meta = {"indexes": [("action", "job_id"), "email_id", "recipient"]}
@@ -1,13 +1,65 @@
 from rest_framework import serializers
 from rest_framework_mongoengine.serializers import DocumentSerializer
 
-from .models import Workflow
+from collections import defaultdict
 
+from helpers.serializers import ExpandableFieldsMixin
+
+from .models import Workflow, EmailJob, Email
+
+
+class EmailSerializer(DocumentSerializer):
+    class Meta:
+        model = Email
+        exclude = ["id", "action", "job_id", "content"]
+
+
+class EmailJobSerializer(DocumentSerializer):
+    emails = serializers.SerializerMethodField()
+
+    def get_emails(self, job):
+        emails = self.context.get("emails", {}).get(job.job_id, [])
+        return EmailSerializer(emails, many=True).data
+
+    class Meta:
+        model = EmailJob
+        exclude = ["id", "action"]
+
+
+class ActionSerializer(ExpandableFieldsMixin, DocumentSerializer):
+    # Evaluating the action against its DataLab, and its email history, are only
+    # included when requested
+    expandable_fields = ["data", "options", "emailJobs"]
 
-class ActionSerializer(DocumentSerializer):
     datalab_name = serializers.ReadOnlyField()
-    data = serializers.ReadOnlyField()
-    options = serializers.ReadOnlyField()
+    data = serializers.SerializerMethodField()
+    options = serializers.SerializerMethodField()
+    emailJobs = serializers.SerializerMethodField()
+
+    def evaluate(self, action):
+        # Share a single evaluation between the data and options of each action
+        evaluations = self.context.setdefault("evaluations", {})
+        if action.id not in evaluations:
+            evaluations[action.id] = action.evaluate()
+
+        return evaluations[action.id]
+
+    def get_data(self, action):
+        return self.evaluate(action).data
+
+    def get_options(self, action):
+        return self.evaluate(action).options
+
+    def get_emailJobs(self, action):
+        # Retrieve the emails of every job in a single query
+        emails = defaultdict(list)
+        for email in action.get_emails().exclude("content"):
+            emails[email.job_id].append(email)
+
+        serializer = EmailJobSerializer(
+            action.get_email_jobs(), many=True, context={"emails": emails}
+        )
+        return serializer.data
 
     class Meta:
         model = Workflow
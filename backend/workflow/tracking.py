@@ -0,0 +1,113 @@
+""" Write-behind buffer for the read receipts of sent emails.
+
+    Tracking pixel hits are appended to an in-process buffer instead of being
+    written to the database as each pixel is requested. The buffer is flushed on
+    a short interval by a background thread, as a single bulk write in which the
+    hits of each email are merged into one update of its track count and first
+    and last tracked times. Hits still buffered when a worker is killed are lost,
+    which is acceptable for tracking statistics. """
+
+from pymongo import UpdateOne
+from bson.objectid import ObjectId
+import threading
+import atexit
+import time
+import os
+
+from ontask.settings import READ_RECEIPT_FLUSH_INTERVAL
+
+from .models import Email
+
+import logging
+
+logger = logging.getLogger("ontask")
+
+_hits = {}
+_lock = threading.Lock()
+_flusher = {"pid": None, "thread": None}
+
+
+def _updates(hits):
+    return [
+        UpdateOne(
+            {"action": action_id, "job_id": job_id, "email_id": email_id},
+            {
+                "$inc": {"track_count": count},
+                "$min": {"first_tracked": first_tracked},
+                "$max": {"last_tracked": last_tracked},
+            },
+        )
+        for (action_id, job_id, email_id), (count, first_tracked, last_tracked) in (
+            hits.items()
+        )
+    ]
+
+
+def write_hits(hits):
+    """ Merges a dict of (action, job_id, email_id) to (count, first, last) into
+        the emails it refers to, in a single bulk write """
+    if not hits:
+        return
+
+    try:
+        Email._get_collection().bulk_write(_updates(hits), ordered=False)
+    except Exception:
+        logger.exception("email.read_receipt_flush", extra={"hits": len(hits)})
+
+
+def flush():
+    global _hits
+
+    with _lock:
+        hits, _hits = _hits, {}
+
+    write_hits(hits)
+
+
+def _run_flusher():
+    while True:
+        time.sleep(READ_RECEIPT_FLUSH_INTERVAL)
+        flush()
+
+
+def _ensure_flusher():
+    # Each forked worker process needs its own flusher thread
+    pid = os.getpid()
+    if _flusher["pid"] == pid:
+        return
+
+    with _lock:
+        if _flusher["pid"] == pid:
+            return
+
+        thread = threading.Thread(target=_run_flusher, daemon=True)
+        thread.start()
+        _flusher.update(pid=pid, thread=thread)
+
+
+def record_hit(action_id, job_id, email_id, tracked_at):
+    """ Records a tracking pixel hit. The hit is written immediately if buffering
+        is disabled, otherwise it is merged into the buffer """
+    try:
+        key = (ObjectId(action_id), ObjectId(job_id), email_id)
+    except Exception:
+        return
+
+    if not READ_RECEIPT_FLUSH_INTERVAL:
+        write_hits({key: (1, tracked_at, tracked_at)})
+        return
+
+    _ensure_flusher()
+
+    with _lock:
+        count, first_tracked, last_tracked = _hits.get(
+            key, (0, tracked_at, tracked_at)
+        )
+        _hits[key] = (
+            count + 1,
+            min(first_tracked, tracked_at),
+            max(last_tracked, tracked_at),
+        )
+
+
+atexit.register(flush)
@@ -1,6 +1,13 @@
 import re
 from dateutil import parser
+from collections import OrderedDict
+from hashlib import md5
+from bson.objectid import ObjectId
+import threading
+import json
 import time
+import numpy as np
+import pandas as pd
 
 
 def transform(value, param_type):
@@ -18,16 +25,98 @@ def transform(value, param_type):
         return None
 
 
-def did_pass_test(test, value, param_type):
-    value = transform(value, param_type)
-    if "comparator" in test:
+def transform_column(values, param_type):
+    """ Applies transform to every value of a column, parsing each distinct
+        value only once """
+    values = values.tolist()
+
+    if param_type not in ["number", "date"]:
+        return values
+
+    transformed = {}
+    result = []
+    for value in values:
+        try:
+            if value not in transformed:
+                transformed[value] = transform(value, param_type)
+            result.append(transformed[value])
+        except TypeError:
+            # Unhashable values (e.g. lists) cannot be cached
+            result.append(transform(value, param_type))
+
+    return result
+
+
+def test_column(test, values, param_type):
+    """ Equivalent of testing each value of a column individually, returning a
+        boolean mask of the values that passed the test """
+    operator = test["operator"]
+
+    # The formula is not modified, so that it can be applied to every column
+    has_comparator = "comparator" in test
+    if has_comparator:
         comparator = transform(test["comparator"], param_type)
+        range_from = test["rangeFrom"]
+        range_to = test["rangeTo"]
     else:
-        test["rangeFrom"] = transform(test["rangeFrom"], param_type)
-        test["rangeTo"] = transform(test["rangeTo"], param_type)
+        comparator = None
+        range_from = transform(test["rangeFrom"], param_type)
+        range_to = transform(test["rangeTo"], param_type)
+
+    uses_comparator = ["==", "!=", "<", "<=", ">", ">=", "contains"]
+    if operator in uses_comparator and not has_comparator:
+        return np.zeros(len(values), dtype=bool)
+
+    if param_type not in ["number", "date"]:
+        return np.array(
+            [
+                test_value(operator, value, comparator, range_from, range_to)
+                for value in values
+            ],
+            dtype=bool,
+        )
+
+    # Numbers and dates are compared as floats, where null values (i.e. those
+    # that could not be transformed) fail any comparison
+    is_null = np.array([value is None for value in values], dtype=bool)
+    numbers = np.array(
+        [np.nan if value is None else value for value in values], dtype=float
+    )
+
+    def compare(operation, other):
+        if not isinstance(other, (int, float)):
+            return np.zeros(len(values), dtype=bool)
+
+        with np.errstate(invalid="ignore"):
+            return ~is_null & operation(numbers, other)
+
+    if operator == "==":
+        return is_null.copy() if comparator is None else compare(np.equal, comparator)
+    elif operator == "!=":
+        return ~is_null if comparator is None else ~compare(np.equal, comparator)
+    elif operator == "IS_NULL":
+        return is_null
+    elif operator == "IS_NOT_NULL":
+        return ~is_null
+    elif operator == "IS_TRUE" or operator == "IS_FALSE":
+        return compare(np.not_equal, 0)
+    elif operator == "<":
+        return compare(np.less, comparator)
+    elif operator == "<=":
+        return compare(np.less_equal, comparator)
+    elif operator == ">":
+        return compare(np.greater, comparator)
+    elif operator == ">=":
+        return compare(np.greater_equal, comparator)
+    elif operator == "between":
+        return compare(np.greater_equal, range_from) & compare(
+            np.less_equal, range_to
+        )
+    else:
+        return np.zeros(len(values), dtype=bool)
 
-    operator = test["operator"]
 
+def test_value(operator, value, comparator, range_from, range_to):
     try:
         if operator == "==":
             return value == comparator
@@ -48,7 +137,7 @@ def did_pass_test(test, value, param_type):
         elif operator == ">=":
             return value >= comparator
         elif operator == "between":
-            return value >= test["rangeFrom"] and value <= test["rangeTo"]
+            return value >= range_from and value <= range_to
         elif operator == "contains":
             return comparator.lower() in (item.lower() for item in value)
         else:
@@ -57,39 +146,167 @@ def did_pass_test(test, value, param_type):
         return False
 
 
-def populate_field(match, item, order):
-    field = match.group(1)
-    value = item.get(field)
+def condition_mask(condition, parameters, data, types, columns=None):
+    """ Boolean mask of the records in the DataFrame which satisfy every formula
+        of the condition. Transformed columns are cached in the given dict, so
+        that each column is only transformed once across conditions """
+    if columns is None:
+        columns = {}
+
+    mask = np.ones(len(data), dtype=bool)
+
+    for parameter_index, parameter in enumerate(parameters):
+        param_type = types.get(parameter)
+
+        if parameter not in columns:
+            values = (
+                data[parameter]
+                if parameter in data
+                else pd.Series([None] * len(data), index=data.index)
+            )
+            columns[parameter] = transform_column(values, param_type)
+
+        mask &= test_column(
+            condition.formulas[parameter_index], columns[parameter], param_type
+        )
+
+    return mask
+
+
+def assign_rules(rules, data, types):
+    """ Assigns each record in the DataFrame to the first condition that it
+        satisfies in each rule, or otherwise to the rule's catch-all. Returns a
+        boolean mask of the assigned records for each condition id """
+    columns = {}
+    populated_rules = {}
+
+    for rule in rules:
+        unassigned = np.ones(len(data), dtype=bool)
+
+        for condition in rule.conditions:
+            mask = condition_mask(condition, rule.parameters, data, types, columns)
+            populated_rules[condition.conditionId] = mask & unassigned
+            unassigned &= ~mask
+
+        populated_rules[rule.catchAll] = unassigned
+
+    return populated_rules
+
+
+ATTRIBUTE_PATTERN = re.compile(r"<attribute>(.*?)</attribute>")
+
+# Compiled content templates, keyed by a hash of the content and column order
+CONTENT_TEMPLATE_CACHE_SIZE = 64
+_content_templates = OrderedDict()
+_content_templates_lock = threading.Lock()
+
+
+def compile_field_formatter(field, order):
+    """ Builds the function which formats a value of the given field, based on
+        the order metadata (checkbox, list option mapping, checkbox-group) """
+    transforms = []
 
     for item in order:
         if item["details"]["label"] == field:
             if item["details"]["field_type"] == "checkbox":
-                value = value if value else "False"
+                transforms.append(("checkbox", None))
 
             elif item["details"]["field_type"] == "list":
-                if not isinstance(value, list):
-                    value = [value]
-
                 mapping = {
                     option["value"]: option["label"]
                     for option in item["details"]["options"]
                 }
-                value = [mapping.get(value, "") for value in value]
+                transforms.append(("list", mapping))
 
         elif field in item["details"].get("fields", []):
-            value = "False" if not value else value
+            transforms.append(("checkbox", None))
+
+    def format_value(value):
+        for transform_type, mapping in transforms:
+            if transform_type == "checkbox":
+                value = value if value else "False"
 
-    if isinstance(value, list):
-        value = ", ".join(value if value else "")
-    elif not isinstance(value, str):
-        value = str(value)
+            elif transform_type == "list":
+                if not isinstance(value, list):
+                    value = [value]
 
-    return value
+                value = [mapping.get(value, "") for value in value]
 
+        if isinstance(value, list):
+            value = ", ".join(value if value else "")
+        elif not isinstance(value, str):
+            value = str(value)
 
-def parse_content_line(line, item, order):
-    return re.sub(
-        r"<attribute>(.*?)</attribute>",
-        lambda match: populate_field(match, item, order),
-        line,
-    )
+        return value
+
+    return format_value
+
+
+class ContentTemplate:
+    """ Content compiled into literal segments and attribute slots, so that it
+        can be populated for each record without any pattern matching """
+
+    def __init__(self, content, order):
+        block_map = content["blockMap"]["document"]["nodes"]
+        html = content["html"]
+
+        self.blocks = []
+        self.formatters = {}
+
+        for block_index, block in enumerate(block_map):
+            condition_id = (
+                ObjectId(block["data"]["conditionId"])
+                if block["type"] == "condition"
+                else None
+            )
+
+            # Even segments are literal html, odd segments are attribute names
+            segments = ATTRIBUTE_PATTERN.split(html[block_index])
+            for field in segments[1::2]:
+                if field not in self.formatters:
+                    self.formatters[field] = compile_field_formatter(field, order)
+
+            self.blocks.append((condition_id, segments))
+
+    def render(self, item, populated_conditions):
+        """ Populates the content for a record, including only the condition
+            blocks whose condition id is in populated_conditions """
+        populated_content = []
+
+        for condition_id, segments in self.blocks:
+            if condition_id is not None and condition_id not in populated_conditions:
+                continue
+
+            for segment_index, segment in enumerate(segments):
+                if segment_index % 2:
+                    segment = self.formatters[segment](item.get(segment))
+                populated_content.append(segment)
+
+        return "".join(populated_content)
+
+
+def compile_content(content, order):
+    """ Returns the compiled template of the content, which is cached by a hash
+        of the content and the column order """
+    key = md5(
+        json.dumps(
+            [content["blockMap"]["document"]["nodes"], content["html"], order],
+            default=str,
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+    with _content_templates_lock:
+        template = _content_templates.get(key)
+        if template:
+            _content_templates.move_to_end(key)
+            return template
+
+    template = ContentTemplate(content, order)
+
+    with _content_templates_lock:
+        _content_templates[key] = template
+        while len(_content_templates) > CONTENT_TEMPLATE_CACHE_SIZE:
+            _content_templates.popitem(last=False)
+
+    return template
@@ -27,6 +27,7 @@ from .models import (
     Schedule,
 )
 from .permissions import WorkflowPermissions
+from .tracking import record_hit
 
 from container.models import Container
 
@@ -43,11 +44,32 @@ PIXEL_GIF_DATA = base64.b64decode(
 )
 
 
+def email_query(action_id, job_id, email_id):
+    """ Query matching a single sent email, which can be updated atomically without
+        loading the email. Returns None if the identifiers are invalid """
+    try:
+        return Email.objects(
+            email_id=email_id, action=ObjectId(action_id), job_id=ObjectId(job_id)
+        )
+    except Exception:
+        return None
+
+
 class WorkflowViewSet(viewsets.ModelViewSet):
     lookup_field = "id"
     serializer_class = ActionSerializer
     permission_classes = [IsAuthenticated, WorkflowPermissions]
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+
+        # The full action is returned when it is opened, whereas lists and the
+        # responses of mutations are lean unless ?expand= is given
+        if self.action == "retrieve":
+            context["expand"] = ["all"]
+
+        return context
+
     def get_queryset(self):
         # Get the containers this user owns or has access to
         containers = Container.objects.filter(
@@ -119,7 +141,7 @@ class WorkflowViewSet(viewsets.ModelViewSet):
 
         action.save()
 
-        serializer = ActionSerializer(action)
+        serializer = self.get_serializer(action)
         return Response(serializer.data)
 
     @detail_route(methods=["post", "put", "delete"])
@@ -173,7 +195,7 @@ class WorkflowViewSet(viewsets.ModelViewSet):
 
         action.save()
 
-        serializer = ActionSerializer(action)
+        serializer = self.get_serializer(action)
         return Response(serializer.data)
 
     @detail_route(methods=["get", "post", "put"])
@@ -198,7 +220,7 @@ class WorkflowViewSet(viewsets.ModelViewSet):
             elif request.method == "PUT":
                 action.content = content
                 action.save()
-                serializer = ActionSerializer(action)
+                serializer = self.get_serializer(action)
 
                 logger.info(
                     "action.update_content",
@@ -243,7 +265,7 @@ class WorkflowViewSet(viewsets.ModelViewSet):
 
         action.save()
 
-        serializer = ActionSerializer(action)
+        serializer = self.get_serializer(action)
         return Response(serializer.data)
 
     @detail_route(methods=["post"])
@@ -266,6 +288,48 @@ class WorkflowViewSet(viewsets.ModelViewSet):
 
         return Response({"success": "true"})
 
+    @detail_route(methods=["post"])
+    def resume_email(self, request, id=None):
+        action = self.get_object()
+        self.check_object_permissions(self.request, action)
+
+        if os.environ.get("ONTASK_DEMO") is not None:
+            raise ValidationError("Email sending is disabled in the demo")
+
+        job = action.get_email_job(request.data.get("job_id"))
+        if not job:
+            raise ValidationError("Email job not found.")
+
+        if job.status != "In progress":
+            raise ValidationError("Email job has already been completed.")
+
+        run = action.claim_email_job(job.job_id)
+        if not run:
+            raise ValidationError("Email job is still being sent.")
+
+        action.send_email(resume_job=str(job.job_id), run=run)
+
+        logger.info(
+            "action.resume_email_send",
+            extra={"user": self.request.user.email, "payload": self.request.data},
+        )
+
+        return Response({"success": "true"})
+
+    @detail_route(methods=["get"])
+    def email_content(self, request, id=None):
+        """ The content of a single sent email, which is not included in the email
+            history of the action """
+        action = self.get_object()
+        self.check_object_permissions(self.request, action)
+
+        query = email_query(action.id, request.GET.get("job"), request.GET.get("email"))
+        email = query.only("content").first() if query is not None else None
+        if not email:
+            raise ValidationError("Email not found.")
+
+        return Response({"content": email.content})
+
     @list_route(methods=["get"], permission_classes=[AllowAny])
     def read_receipt(self, request):
         token = request.GET.get("email")
@@ -278,24 +342,13 @@ class WorkflowViewSet(viewsets.ModelViewSet):
                 # Invalid token, ignore the read receipt
                 return HttpResponse(PIXEL_GIF_DATA, content_type="image/gif")
 
-            action = Workflow.objects.get(id=decrypted_token["action_id"])
-
-            did_update = False
-            for job in action.emailJobs:
-                if str(job.job_id) == decrypted_token["job_id"]:
-                    for email in job.emails:
-                        if email.email_id == decrypted_token["email_id"]:
-                            if not email.first_tracked:
-                                email.first_tracked = datetime.utcnow()
-                            else:
-                                email.last_tracked = datetime.utcnow()
-                            email.track_count += 1
-                            did_update = True
-                            break
-                    break
-
-            if did_update:
-                action.save()
+            # Read receipts are buffered and written in bulk in the background
+            record_hit(
+                decrypted_token["action_id"],
+                decrypted_token["job_id"],
+                decrypted_token["email_id"],
+                datetime.utcnow(),
+            )
 
         return HttpResponse(PIXEL_GIF_DATA, content_type="image/gif")
 
@@ -338,31 +391,31 @@ class FeedbackView(APIView):
         email_id = request.GET.get("email")
 
         payload = None
-        for job in action.emailJobs:
-            if str(job.job_id) == job_id and job.included_feedback:
-                for email in job.emails:
-                    if email.email_id == email_id:
-                        payload = {
-                            "dropdown": {
-                                "enabled": action.emailSettings.feedback_list,
-                                "question": action.emailSettings.list_question,
-                                "type": action.emailSettings.list_type,
-                                "options": [
-                                    {"label": option.label, "value": option.value}
-                                    for option in action.emailSettings.list_options
-                                ],
-                                "value": email.list_feedback,
-                            },
-                            "textbox": {
-                                "enabled": action.emailSettings.feedback_textbox,
-                                "question": action.emailSettings.textbox_question,
-                                "value": email.textbox_feedback,
-                            },
-                            "subject": job.subject,
-                            "email_datetime": job.initiated_at,
-                            # "content": email.content,
-                            "feedback_datetime": email.feedback_datetime,
-                        }
+        job = action.get_email_job(job_id)
+        email = email_query(action.id, job_id, email_id)
+        email = email.exclude("content").first() if email is not None else None
+        if job and job.included_feedback and email:
+            payload = {
+                "dropdown": {
+                    "enabled": action.emailSettings.feedback_list,
+                    "question": action.emailSettings.list_question,
+                    "type": action.emailSettings.list_type,
+                    "options": [
+                        {"label": option.label, "value": option.value}
+                        for option in action.emailSettings.list_options
+                    ],
+                    "value": email.list_feedback,
+                },
+                "textbox": {
+                    "enabled": action.emailSettings.feedback_textbox,
+                    "question": action.emailSettings.textbox_question,
+                    "value": email.textbox_feedback,
+                },
+                "subject": job.subject,
+                "email_datetime": job.initiated_at,
+                # "content": email.content,
+                "feedback_datetime": email.feedback_datetime,
+            }
 
         if not payload:
             return JsonResponse({"error": "Invalid feedback URL"})
@@ -370,7 +423,7 @@ class FeedbackView(APIView):
         return JsonResponse(payload)
 
     def post(self, request, format=None, *args, **kwargs):
-        action = Workflow.objects.get(id=kwargs.get("datalab_id"))
+        action_id = kwargs.get("datalab_id")
         job_id = request.GET.get("job")
         email_id = request.GET.get("email")
 
@@ -381,18 +434,20 @@ class FeedbackView(APIView):
             return JsonResponse({"error": "Empty feedback cannot be submitted"})
 
         did_update = False
-        for job in action.emailJobs:
-            if str(job.job_id) == job_id and job.included_feedback:
-                for email in job.emails:
-                    if email.email_id == email_id:
-                        email.textbox_feedback = textbox
-                        email.list_feedback = dropdown
-                        email.feedback_datetime = datetime.utcnow()
-                        did_update = True
-
-        if did_update:
-            action.save()
-        else:
+        email = email_query(action_id, job_id, email_id)
+        if (
+            email is not None
+            and EmailJob.objects(
+                action=ObjectId(action_id), job_id=job_id, included_feedback=True
+            ).count()
+        ):
+            did_update = email.update_one(
+                set__textbox_feedback=textbox,
+                set__list_feedback=dropdown,
+                set__feedback_datetime=datetime.utcnow(),
+            )
+
+        if not did_update:
             # None of the email recipients must have matched the request user's email
             return JsonResponse(
                 {
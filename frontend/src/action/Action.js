@@ -58,7 +58,9 @@ class Action extends React.Component {
   }
 
   updateAction = action => {
-    this.setState({ action });
+    // Responses to updates only include the expensive fields (data, options and
+    // email jobs) when requested, so merge them into the current action
+    this.setState({ action: { ...this.state.action, ...action } });
   };
 
   render() {
@@ -31,7 +31,8 @@ class ActionSettings extends React.Component {
       const containerId = _.get(location, "state.containerId");
       if (containerId) payload.container = containerId;
 
-      apiRequest(action ? `/workflow/${action.id}/` : "/workflow/", {
+      const url = action ? `/workflow/${action.id}/` : "/workflow/";
+      apiRequest(`${url}?expand=all`, {
         method: action ? "PATCH" : "POST",
         payload,
         onSuccess: action => {
@@ -67,7 +67,7 @@ class Compose extends React.Component {
   updateFilter = ({ filter, method, onSuccess, onError }) => {
     const { action, updateAction } = this.props;
 
-    apiRequest(`/workflow/${action.id}/filter/`, {
+    apiRequest(`/workflow/${action.id}/filter/?expand=data`, {
       method,
       payload: { filter },
       onSuccess: action => {
@@ -204,6 +204,43 @@ class Email extends React.Component {
     </div>
   );
 
+  viewEmail = (job, email) => {
+    const { action } = this.props;
+
+    this.setState({
+      emailView: {
+        visible: true,
+        emailId: email.email_id,
+        recipient: email.recipient,
+        subject: job.subject,
+        initiated_at: job.initiated_at
+      }
+    });
+
+    // The content of sent emails is not included in the email history, and is
+    // only fetched when an email is viewed
+    apiRequest(
+      `/workflow/${action.id}/email_content/?job=${job.job_id}&email=${
+        email.email_id
+      }`,
+      {
+        method: "GET",
+        onSuccess: ({ content }) => {
+          const { emailView } = this.state;
+          if (emailView.visible && emailView.emailId === email.email_id)
+            this.setState({ emailView: { ...emailView, text: content } });
+        },
+        onError: error => {
+          this.setState({ emailView: { visible: false } });
+          notification["error"]({
+            message: "Failed to load email",
+            description: error
+          });
+        }
+      }
+    );
+  };
+
   EmailJobDetails = job => (
     <Table
       size="small"
@@ -248,21 +285,11 @@ class Email extends React.Component {
         },
         {
           title: "Content",
-          dataIndex: "content",
           key: "content",
           render: (text, record) => (
             <span
               style={{ cursor: "pointer", color: "#2196F3" }}
-              onClick={() =>
-                this.setState({
-                  emailView: {
-                    visible: true,
-                    recipient: record.recipient,
-                    subject: job.subject,
-                    text
-                  }
-                })
-              }
+              onClick={() => this.viewEmail(job, record)}
             >
               View
             </span>
@@ -345,12 +372,16 @@ class Email extends React.Component {
               {moment(emailView.initiated_at).format("DD/MM/YYYY, HH:mm")}
             </div>
             <Divider />
-            <div
-              className="email_content"
-              dangerouslySetInnerHTML={{
-                __html: emailView.text
-              }}
-            />
+            {emailView.text === undefined ? (
+              <Spin />
+            ) : (
+              <div
+                className="email_content"
+                dangerouslySetInnerHTML={{
+                  __html: emailView.text
+                }}
+              />
+            )}
           </div>
         </Modal>
       </div>
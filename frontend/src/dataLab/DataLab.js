@@ -1,6 +1,6 @@
 import React from "react";
 import { Switch, Route, Link, Redirect } from "react-router-dom";
-import { Spin, Layout, Icon, Menu } from "antd";
+import { Spin, Layout, Icon, Menu, notification } from "antd";
 import { DragDropContext } from "react-dnd";
 import HTML5Backend from "react-dnd-html5-backend";
 import _ from "lodash";
@@ -16,6 +16,9 @@ import apiRequest from "../shared/apiRequest";
 const { Content, Sider } = Layout;
 const SubMenu = Menu.SubMenu;
 
+// Milliseconds between checks for the rebuild of the data after a form change
+const RELATIONS_POLL_INTERVAL = 2000;
+
 class DataLab extends React.Component {
   state = { fetching: true, forms: [] };
 
@@ -73,12 +76,50 @@ class DataLab extends React.Component {
     }
   }
 
+  componentWillUnmount() {
+    clearTimeout(this.relationsPoll);
+  }
+
   updateDatalab = dataLab => {
     const { selected } = this.state;
 
     this.setState({
       selected: { ...selected, ...dataLab }
     });
+
+    // The data is rebuilt in the background after a form is changed, so it is
+    // fetched once the rebuild has completed
+    if (dataLab.relationsStatus === "pending") this.pollRelations(dataLab.id);
+  };
+
+  pollRelations = dataLabId => {
+    clearTimeout(this.relationsPoll);
+
+    this.relationsPoll = setTimeout(() => {
+      apiRequest(`/datalab/${dataLabId}/?fields=id,relationsStatus`, {
+        method: "GET",
+        onSuccess: ({ relationsStatus }) => {
+          if (relationsStatus === "pending") {
+            this.pollRelations(dataLabId);
+          } else if (relationsStatus === "complete") {
+            apiRequest(
+              `/datalab/${dataLabId}/?fields=id,relationsStatus,columns,data&expand=data`,
+              {
+                method: "GET",
+                onSuccess: dataLab => this.updateDatalab(dataLab)
+              }
+            );
+          } else {
+            this.updateDatalab({ relationsStatus });
+            notification["error"]({
+              message: "Data could not be updated",
+              description:
+                "The data of the DataLab could not be rebuilt after the form was updated."
+            });
+          }
+        }
+      });
+    }, RELATIONS_POLL_INTERVAL);
   };
 
   updateData = (index, field, value) => {
@@ -129,7 +129,8 @@ class Model extends React.Component {
       const containerId = _.get(location, "state.containerId");
       if (containerId) build.container = containerId;
 
-      apiRequest(selectedId ? `/datalab/${selectedId}/` : "/datalab/", {
+      const url = selectedId ? `/datalab/${selectedId}/` : "/datalab/";
+      apiRequest(`${url}?expand=data,forms,actions`, {
         method: selectedId ? "PATCH" : "POST",
         payload: build,
         onSuccess: dataLab => {
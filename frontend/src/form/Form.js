@@ -228,20 +228,28 @@ class Form extends React.Component {
       method: "POST",
       payload,
       isJSON: false,
-      onSuccess: () => {
+      onSuccess: result => {
         apiRequest(`/form/${match.params.id}/access/`, {
           method: "GET",
           onSuccess: form => {
             this.setState({ loading: false, upload: false, form });
+            const { inserted, updated, rejected } = result;
             notification["success"]({
-              message: "Successfully imported form data"
+              message: "Successfully imported form data",
+              description:
+                `${inserted} records added and ${updated} updated.` +
+                (rejected
+                  ? ` ${rejected} rows did not match a record and were skipped.`
+                  : "")
             });
           }
         });
       },
-      onError: () => {
+      onError: error => {
+        this.setState({ loading: false });
         notification["error"]({
-          message: "Failed to import form data"
+          message: "Failed to import form data",
+          description: error
         });
       }
     });